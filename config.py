@@ -1,9 +1,9 @@
 import os
 from dataclasses import dataclass, field
+from pathlib import Path
 from datetime import datetime, date
 from zoneinfo import ZoneInfo
-from dotenv import load_dotenv
-from typing import List
+from typing import FrozenSet
 
 # Часовой пояс для регистрации, подписки и отчётов (время в БД и сравнения)
 APP_TIMEZONE = "Europe/Moscow"
@@ -21,8 +21,12 @@ def today_moscow() -> date:
 # Базовая директория проекта (там, где лежит этот файл config.py)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Загружаем переменные окружения из .env в корне проекта (независимо от текущей директории)
-load_dotenv(os.path.join(BASE_DIR, ".env"))
+# Загружаем переменные окружения из .env в корне проекта (независимо от текущей
+# директории). Если BOT_TOKEN уже задан окружением (например, в контейнере),
+# парсинг .env и сам импорт dotenv не нужны
+if not os.getenv("BOT_TOKEN"):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(BASE_DIR, ".env"))
 
 
 @dataclass
@@ -47,10 +51,11 @@ class Config:
     MOYSKLAD_API_BASE_URL: str = "https://api.moysklad.ru/api/remap/1.2"
     REQUEST_TIMEOUT: int = int(os.getenv("REQUEST_TIMEOUT", "30"))
 
-    # Настройки бота - используем field с default_factory для списка
-    ADMIN_IDS: List[int] = field(default_factory=lambda:
-    list(map(int, os.getenv("ADMIN_IDS", "").split(","))) if os.getenv("ADMIN_IDS") else []
-                                 )
+    # Настройки бота - frozenset: проверка "user_id in ADMIN_IDS" выполняется
+    # на каждом апдейте, хеш-поиск дешевле перебора списка
+    ADMIN_IDS: FrozenSet[int] = field(default_factory=lambda: frozenset(
+        int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()
+    ))
 
     # GigaChat
     GIGACHAT_CREDENTIALS: str = os.getenv("GIGACHAT_CREDENTIALS", "")
@@ -91,14 +96,18 @@ class Config:
         return key
 
     def setup_dirs(self):
-        """Создание необходимых директорий"""
-        os.makedirs(self.DATA_DIR, exist_ok=True)
-        os.makedirs(self.LOGS_DIR, exist_ok=True)
-
-        # Создаем папку для базы данных, если нужно
-        db_dir = os.path.dirname(self.DB_PATH)
-        if db_dir and not os.path.exists(db_dir):
-            os.makedirs(db_dir, exist_ok=True)
+        """Создание необходимых директорий (однократно на процесс)"""
+        if getattr(self, "_dirs_ready", False):
+            return
+
+        Path(self.DATA_DIR).mkdir(parents=True, exist_ok=True)
+        Path(self.LOGS_DIR).mkdir(parents=True, exist_ok=True)
+
+        # Папка для базы данных: mkdir с exist_ok сам обрабатывает
+        # существующую директорию, отдельный stat не нужен
+        Path(self.DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+
+        self._dirs_ready = True
 
 
 # Создаем экземпляр конфигурации
@@ -1,5 +1,10 @@
 import sqlite3
 import logging
+import queue
+import threading
+import atexit
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
 from typing import Optional, Dict, Any
 from contextlib import contextmanager
@@ -8,20 +13,214 @@ from config import now_moscow
 
 logger = logging.getLogger(__name__)
 
+# Размер пула соединений: бот обслуживает много мелких запросов,
+# постоянные соединения убирают накладные расходы connect/close
+POOL_SIZE = 4
+
+# Версия схемы в PRAGMA user_version: DDL из init_db выполняется только
+# когда версия в файле БД отличается
+SCHEMA_VERSION = 2
+
+# Логи запросов пишутся пачками: одна транзакция на пакет вместо
+# commit+fsync на каждое действие пользователя
+LOG_FLUSH_INTERVAL = 2.0  # секунд
+LOG_FLUSH_THRESHOLD = 100  # записей
+
+# SQL горячих запросов хостим в константы модуля: кеш statement'ов sqlite3
+# ключуется по identity строки, так что одна и та же константа
+# переиспользует уже скомпилированный запрос
+_SQL_ADD_USER = '''
+    INSERT INTO users (telegram_id, phone_number, created_at, last_active)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        last_active = excluded.last_active
+    RETURNING id
+'''
+
+# Московское время (UTC+3, без DST) считаем на стороне SQLite —
+# без аллокации datetime и маршалинга параметра на каждый UPDATE
+_SQL_NOW_MOSCOW = "datetime('now', '+3 hours')"
+
+_SQL_UPDATE_USER_TOKEN = f'''
+    UPDATE users
+    SET api_token_encrypted = ?, last_active = {_SQL_NOW_MOSCOW}
+    WHERE telegram_id = ?
+'''
+
+# Явный список колонок: порядок гарантирован и не зависит от того,
+# в каком порядке ALTER TABLE добавлял колонки в старых БД
+_SQL_GET_USER = '''
+    SELECT u.id, u.telegram_id, u.phone_number, u.api_token_encrypted IS NOT NULL AS has_token,
+           u.created_at, u.last_active, u.is_active,
+           u.subscription_status, u.trial_started_at,
+           u.subscription_expires_at, u.last_subscription_notified_at,
+           us.default_report_type, us.notification_enabled,
+           us.notification_daily_time, us.notification_weekly_time,
+           us.notification_monthly_time, us.timezone, us.updated_at
+    FROM users u
+    LEFT JOIN user_settings us ON u.id = us.user_id
+    WHERE u.telegram_id = ?
+'''
+
+_SQL_GET_USER_TOKEN = "SELECT api_token_encrypted FROM users WHERE telegram_id = ?"
+
+_SQL_GET_USER_TIMEZONE = '''
+    SELECT us.timezone
+    FROM users u
+    JOIN user_settings us ON u.id = us.user_id
+    WHERE u.telegram_id = ?
+'''
+
+_SQL_LOG_REQUEST = '''
+    INSERT INTO request_logs (user_id, request_type, period)
+    VALUES (?, ?, ?)
+'''
+
+_SQL_GET_USER_ID = "SELECT id FROM users WHERE telegram_id = ?"
+
+_SQL_UPDATE_LAST_ACTIVE = f'''
+    UPDATE users
+    SET last_active = {_SQL_NOW_MOSCOW}
+    WHERE telegram_id = ?
+'''
+
+_SQL_USERS_WITH_NOTIFICATIONS = '''
+    SELECT u.telegram_id, u.api_token_encrypted
+    FROM users u
+    JOIN user_settings s ON u.id = s.user_id
+    WHERE s.notification_enabled = 1
+      AND u.api_token_encrypted IS NOT NULL
+      AND u.is_active = 1
+'''
+
+_SQL_UPSERT_NOTIFICATION = f'''
+    INSERT INTO user_settings (user_id, notification_enabled, updated_at)
+    SELECT id, ?, {_SQL_NOW_MOSCOW} FROM users WHERE telegram_id = ?
+    ON CONFLICT(user_id) DO UPDATE SET
+        notification_enabled = excluded.notification_enabled,
+        updated_at = excluded.updated_at
+'''
+
+_SQL_NOTIFICATION_STATUS = '''
+    SELECT s.notification_enabled
+    FROM users u
+    JOIN user_settings s ON u.id = s.user_id
+    WHERE u.telegram_id = ?
+'''
+
+_SQL_NOTIFICATION_TIMES = '''
+    SELECT s.notification_daily_time,
+           s.notification_weekly_time,
+           s.notification_monthly_time
+    FROM users u
+    JOIN user_settings s ON u.id = s.user_id
+    WHERE u.telegram_id = ?
+'''
+
+
+@dataclass(slots=True, frozen=True)
+class UserRow:
+    """Строка пользователя из get_user (users LEFT JOIN user_settings).
+
+    Собирается из позиционного кортежа без sqlite3.Row и dict(row) —
+    дешевле по аллокациям; доступ по ключу (user['id'], user.get(...))
+    сохранён для совместимости с существующими вызовами.
+    """
+    id: int
+    telegram_id: int
+    phone_number: Optional[str]
+    has_token: int
+    created_at: Optional[str]
+    last_active: Optional[str]
+    is_active: int
+    subscription_status: Optional[str]
+    trial_started_at: Optional[str]
+    subscription_expires_at: Optional[str]
+    last_subscription_notified_at: Optional[str]
+    default_report_type: Optional[str]
+    notification_enabled: Optional[int]
+    notification_daily_time: Optional[str]
+    notification_weekly_time: Optional[str]
+    notification_monthly_time: Optional[str]
+    timezone: Optional[str]
+    updated_at: Optional[str]
+
+    def __getitem__(self, key: str) -> Any:
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
 
 class Database:
     """Класс для работы с базой данных SQLite"""
 
     def __init__(self, db_path: str):
         self.db_path = db_path
+        # Писатель в SQLite всегда один: сериализуем записи внутри процесса,
+        # чтобы не упираться в SQLITE_BUSY и ретраи busy_timeout
+        self._write_lock = threading.Lock()
+        self._pool: queue.Queue = queue.Queue(maxsize=POOL_SIZE)
+        # Буферы отложенной записи: request_logs (см. log_request) и
+        # отметки последней активности (см. update_last_active) уходят
+        # на диск одной общей транзакцией
+        self._log_buffer: deque = deque()
+        self._last_active_buffer: set = set()
+        self._log_lock = threading.Lock()
+        self._log_flush_timer: Optional[threading.Timer] = None
+        atexit.register(self.flush_request_logs)
+        # Сначала одно соединение и DDL, остальной пул — после: соединения,
+        # открытые до миграции, держат устаревший кеш схемы
+        self._pool.put(self._create_connection())
         self.init_db()
+        for _ in range(POOL_SIZE - 1):
+            self._pool.put(self._create_connection())
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """Создание нового соединения для пула"""
+        # Остаёмся на stdlib sqlite3 (а не apsw): основные преимущества
+        # тонкой обёртки уже закрыты здесь же — кеш подготовленных
+        # statement'ов (cached_statements) и isolation_level=None,
+        # отключающий разбор каждого statement'а ради неявного BEGIN.
+        # Чтение идёт в autocommit, транзакции записи открываются явно
+        # в get_connection
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=256,
+            isolation_level=None,
+        )
+        conn.row_factory = sqlite3.Row
+
+        # WAL позволяет читателям не блокироваться на писателе,
+        # synchronous=NORMAL убирает лишние fsync на каждый commit
+        journal_mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if journal_mode.lower() != "wal":
+            logger.warning(f"Не удалось включить WAL, journal_mode={journal_mode}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA busy_timeout=5000")
+        # Каскадное удаление включается на каждом соединении отдельно
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
 
     @contextmanager
-    def get_connection(self):
-        """Контекстный менеджер для соединения с БД"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+    def get_connection(self, write: bool = False):
+        """Контекстный менеджер для соединения с БД (из пула).
+
+        Чтение выполняется в autocommit (одиночным SELECT'ам транзакция
+        не нужна). При write=True транзакция стартует через BEGIN IMMEDIATE
+        под общим локом: блокировка записи берётся сразу, без апгрейда
+        deferred-транзакции и связанных с ним SQLITE_BUSY.
+        """
+        if write:
+            self._write_lock.acquire()
+        conn = self._pool.get()
         try:
+            if write:
+                conn.execute("BEGIN IMMEDIATE")
             yield conn
             conn.commit()
         except Exception as e:
@@ -29,15 +228,25 @@ class Database:
             logger.error(f"Database error: {e}")
             raise
         finally:
-            conn.close()
+            self._pool.put(conn)
+            if write:
+                self._write_lock.release()
 
     def init_db(self):
         """Инициализация базы данных"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
 
-            # Таблица пользователей
-            cursor.execute('''
+            # БД уже на актуальной схеме — повторный прогон DDL не нужен
+            current_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if current_version == SCHEMA_VERSION:
+                return
+
+            # Все CREATE TABLE выполняем одним скриптом в одной транзакции —
+            # один fsync на старте вместо трёх отдельных
+            cursor.executescript('''
+                BEGIN;
+
                 CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     telegram_id INTEGER UNIQUE NOT NULL,
@@ -50,25 +259,8 @@ class Database:
                     trial_started_at TIMESTAMP,
                     subscription_expires_at TIMESTAMP,
                     last_subscription_notified_at DATE
-                )
-            ''')
+                );
 
-            # На случай уже существующей таблицы — добавляем недостающие колонки безопасно
-            alter_statements = [
-                "ALTER TABLE users ADD COLUMN subscription_status TEXT DEFAULT 'none'",
-                "ALTER TABLE users ADD COLUMN trial_started_at TIMESTAMP",
-                "ALTER TABLE users ADD COLUMN subscription_expires_at TIMESTAMP",
-                "ALTER TABLE users ADD COLUMN last_subscription_notified_at DATE",
-            ]
-            for stmt in alter_statements:
-                try:
-                    cursor.execute(stmt)
-                except Exception:
-                    # Колонка уже есть или другая не критичная ошибка миграции — игнорируем
-                    pass
-
-            # Таблица настроек пользователей
-            cursor.execute('''
                 CREATE TABLE IF NOT EXISTS user_settings (
                     user_id INTEGER NOT NULL,
                     default_report_type TEXT DEFAULT 'today',
@@ -79,102 +271,151 @@ class Database:
                     timezone TEXT DEFAULT 'Europe/Moscow',
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-                )
+                );
+
+                CREATE TABLE IF NOT EXISTS request_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    request_type TEXT,
+                    period TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_request_logs_user_id
+                    ON request_logs(user_id);
+
+                CREATE INDEX IF NOT EXISTS idx_users_notify
+                    ON users(id)
+                    WHERE is_active = 1 AND api_token_encrypted IS NOT NULL;
+
+                CREATE TRIGGER IF NOT EXISTS trg_user_settings
+                    AFTER INSERT ON users
+                BEGIN
+                    INSERT INTO user_settings (user_id) VALUES (NEW.id);
+                END;
+
+                COMMIT;
             ''')
 
-            settings_alter_statements = [
+            # На случай уже существующей таблицы — добавляем недостающие колонки безопасно
+            alter_statements = [
+                "ALTER TABLE users ADD COLUMN subscription_status TEXT DEFAULT 'none'",
+                "ALTER TABLE users ADD COLUMN trial_started_at TIMESTAMP",
+                "ALTER TABLE users ADD COLUMN subscription_expires_at TIMESTAMP",
+                "ALTER TABLE users ADD COLUMN last_subscription_notified_at DATE",
                 "ALTER TABLE user_settings ADD COLUMN notification_daily_time TEXT DEFAULT '09:00'",
                 "ALTER TABLE user_settings ADD COLUMN notification_weekly_time TEXT DEFAULT '09:05'",
                 "ALTER TABLE user_settings ADD COLUMN notification_monthly_time TEXT DEFAULT '09:01'",
+                # Связь users -> user_settings строго 1:1 — убираем возможные
+                # дубли и заменяем старый индекс на уникальный, чтобы планировщик
+                # знал, что JOIN даёт не больше одной строки, а запись могла
+                # идти через UPSERT по user_id
+                "DELETE FROM user_settings WHERE rowid NOT IN "
+                "(SELECT MIN(rowid) FROM user_settings GROUP BY user_id)",
+                "DROP INDEX IF EXISTS idx_user_settings_user_id",
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_settings_user_id "
+                "ON user_settings(user_id)",
             ]
-            for stmt in settings_alter_statements:
+            for stmt in alter_statements:
                 try:
                     cursor.execute(stmt)
                 except Exception:
                     # Колонка уже есть или другая не критичная ошибка миграции — игнорируем
                     pass
 
-            # Таблица логов запросов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS request_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    request_type TEXT,
-                    period TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             logger.info("Database initialized successfully")
 
     def add_user(self, telegram_id: int, phone_number: str = None) -> int:
         """Добавление нового пользователя"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-
-            # Проверяем, существует ли пользователь
-            cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-            existing = cursor.fetchone()
-
-            if existing:
-                return existing['id']
-
-            # Добавляем нового пользователя (время по Москве)
+        with self.get_connection(write=True) as conn:
+            # Один upsert вместо SELECT + INSERT + INSERT: настройки по умолчанию
+            # создаёт триггер trg_user_settings, id возвращается через RETURNING
             now = now_moscow()
-            cursor.execute('''
-                INSERT INTO users (telegram_id, phone_number, created_at, last_active)
-                VALUES (?, ?, ?, ?)
-            ''', (telegram_id, phone_number, now, now))
-
-            user_id = cursor.lastrowid
-
-            # Добавляем настройки по умолчанию
-            cursor.execute('''
-                INSERT INTO user_settings (user_id)
-                VALUES (?)
-            ''', (user_id,))
+            cursor = conn.execute(_SQL_ADD_USER, (telegram_id, phone_number, now, now))
+            user_id = cursor.fetchone()[0]
 
             logger.info(f"New user added: {telegram_id}")
             return user_id
 
     def update_user_token(self, telegram_id: int, encrypted_token: str) -> bool:
         """Обновление API-токена пользователя"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET api_token_encrypted = ?, last_active = ?
-                WHERE telegram_id = ?
-            ''', (encrypted_token, now_moscow(), telegram_id))
+        with self.get_connection(write=True) as conn:
+            cursor = conn.execute(
+                _SQL_UPDATE_USER_TOKEN,
+                (encrypted_token, telegram_id)
+            )
 
             updated = cursor.rowcount > 0
             if updated:
                 logger.info(f"Token updated for user: {telegram_id}")
             return updated
 
-    def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+    def get_user(self, telegram_id: int) -> Optional[UserRow]:
         """Получение данных пользователя"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT u.*, us.* 
-                FROM users u
-                LEFT JOIN user_settings us ON u.id = us.user_id
-                WHERE u.telegram_id = ?
-            ''', (telegram_id,))
+            cursor.row_factory = None
+            row = cursor.execute(_SQL_GET_USER, (telegram_id,)).fetchone()
+            return UserRow(*row) if row else None
 
-            row = cursor.fetchone()
-            return dict(row) if row else None
+    def get_user_token(self, telegram_id: int) -> Optional[str]:
+        """Получение только зашифрованного API-токена пользователя.
 
-    def log_request(self, user_id: int, request_type: str, period: str):
-        """Логирование запроса пользователя"""
+        Узкая проекция для горячего пути отчётов: не тянет все колонки
+        users/user_settings и не собирает dict, в отличие от get_user.
+        """
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO request_logs (user_id, request_type, period)
-                VALUES (?, ?, ?)
-            ''', (user_id, request_type, period))
+            row = conn.execute(_SQL_GET_USER_TOKEN, (telegram_id,)).fetchone()
+            return row[0] if row else None
+
+    def get_user_timezone(self, telegram_id: int) -> str:
+        """Получение часового пояса пользователя (по умолчанию Москва)."""
+        with self.get_connection() as conn:
+            row = conn.execute(_SQL_GET_USER_TIMEZONE, (telegram_id,)).fetchone()
+            return row[0] if row and row[0] else "Europe/Moscow"
+
+    def log_request(self, user_id: int, request_type: str, period: str):
+        """Логирование запроса пользователя (отложенная запись).
+
+        Запись только добавляется в буфер; на диск буфер уходит одной
+        транзакцией через executemany — по таймеру или при накоплении
+        LOG_FLUSH_THRESHOLD записей.
+        """
+        with self._log_lock:
+            self._log_buffer.append((user_id, request_type, period))
+            pending = len(self._log_buffer)
+            if pending < LOG_FLUSH_THRESHOLD and self._log_flush_timer is None:
+                timer = threading.Timer(LOG_FLUSH_INTERVAL, self.flush_request_logs)
+                timer.daemon = True
+                timer.start()
+                self._log_flush_timer = timer
+        if pending >= LOG_FLUSH_THRESHOLD:
+            # Переполнение буфера сбрасываем в фоновом потоке: вызывающий
+            # (обычно event loop бота) не должен ждать записи на диск
+            threading.Thread(target=self.flush_request_logs, daemon=True).start()
+
+    def flush_request_logs(self):
+        """Сброс накопленных отложенных записей в БД одной транзакцией."""
+        with self._log_lock:
+            if self._log_flush_timer is not None:
+                self._log_flush_timer.cancel()
+                self._log_flush_timer = None
+            if not self._log_buffer and not self._last_active_buffer:
+                return
+            batch = list(self._log_buffer)
+            self._log_buffer.clear()
+            active_batch = [(tid,) for tid in self._last_active_buffer]
+            self._last_active_buffer.clear()
+        try:
+            with self.get_connection(write=True) as conn:
+                if batch:
+                    conn.executemany(_SQL_LOG_REQUEST, batch)
+                if active_batch:
+                    conn.executemany(_SQL_UPDATE_LAST_ACTIVE, active_batch)
+        except Exception as e:
+            logger.error(f"Не удалось записать пакет отложенных записей: {e}")
 
     # ===== Методы подписки =====
 
@@ -192,7 +433,7 @@ class Database:
             expires_at: Дата окончания подписки/триала
             trial_started_at: Дата начала триала
         """
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
 
             fields = ["subscription_status = ?"]
@@ -226,7 +467,7 @@ class Database:
 
     def set_subscription_status(self, telegram_id: int, status: str) -> bool:
         """Обновление только статуса подписки (без изменения дат)."""
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -267,7 +508,7 @@ class Database:
         """
         Обновить дату последнего уведомления по подписке.
         """
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -283,36 +524,47 @@ class Database:
             return updated
 
     def update_last_active(self, telegram_id: int):
-        """Обновление времени последней активности"""
+        """Обновление времени последней активности (отложенная запись).
+
+        Идентификатор только добавляется в буфер (повторные касания
+        схлопываются) и пишется вместе с пакетом логов запросов —
+        отдельная транзакция на каждое касание не нужна.
+        """
+        with self._log_lock:
+            self._last_active_buffer.add(telegram_id)
+            if self._log_flush_timer is None:
+                timer = threading.Timer(LOG_FLUSH_INTERVAL, self.flush_request_logs)
+                timer.daemon = True
+                timer.start()
+                self._log_flush_timer = timer
+
+    def iter_notification_targets(self):
+        """
+        Итератор по пользователям с включенными уведомлениями.
+
+        Читает порциями по 256 строк, не материализуя весь список —
+        цикл рассылки может потреблять кортежи по мере отправки.
+
+        Yields:
+            tuple: (telegram_id, encrypted_api_token)
+        """
         with self.get_connection() as conn:
+            # Без row_factory sqlite3 отдаёт готовые кортежи в порядке колонок —
+            # Python-цикл по Row-объектам не нужен
             cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET last_active = ?
-                WHERE telegram_id = ?
-            ''', (now_moscow(), telegram_id))
+            cursor.row_factory = None
+            cursor.execute(_SQL_USERS_WITH_NOTIFICATIONS)
+            while chunk := cursor.fetchmany(256):
+                yield from chunk
 
     def get_users_with_notifications(self) -> list:
         """
         Получить список пользователей с включенными уведомлениями
-        
+
         Returns:
             List[tuple]: Список кортежей (telegram_id, encrypted_api_token)
         """
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT u.telegram_id, u.api_token_encrypted
-                FROM users u
-                JOIN user_settings s ON u.id = s.user_id
-                WHERE s.notification_enabled = 1 
-                  AND u.api_token_encrypted IS NOT NULL
-                  AND u.is_active = 1
-            ''')
-            
-            results = cursor.fetchall()
-            # Преобразуем Row объекты в кортежи
-            return [(row['telegram_id'], row['api_token_encrypted']) for row in results]
+        return list(self.iter_notification_targets())
 
     def get_users_for_scheduled_report(self, period_type: str, target_time: str) -> list:
         """
@@ -358,31 +610,21 @@ class Database:
         Returns:
             bool: True если обновление успешно
         """
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Получаем ID пользователя
-            cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-            user = cursor.fetchone()
-            
-            if not user:
-                logger.warning(f"Пользователь {telegram_id} не найден")
-                return False
-            
-            user_id = user['id']
-            
-            # Обновляем настройку
-            cursor.execute('''
-                UPDATE user_settings 
-                SET notification_enabled = ?, updated_at = ?
-                WHERE user_id = ?
-            ''', (1 if enabled else 0, now_moscow(), user_id))
-            
+        with self.get_connection(write=True) as conn:
+            # Один UPSERT вместо пары SELECT id + UPDATE: настройки создаются,
+            # если их ещё нет; rowcount == 0 только для несуществующего пользователя
+            cursor = conn.execute(
+                _SQL_UPSERT_NOTIFICATION,
+                (1 if enabled else 0, telegram_id)
+            )
+
             updated = cursor.rowcount > 0
-            
+
             if updated:
                 logger.info(f"Уведомления {'включены' if enabled else 'выключены'} для пользователя {telegram_id}")
-            
+            else:
+                logger.warning(f"Пользователь {telegram_id} не найден")
+
             return updated
 
     def get_notification_status(self, telegram_id: int) -> Optional[bool]:
@@ -396,15 +638,7 @@ class Database:
             bool: True если уведомления включены, False если выключены, None если пользователь не найден
         """
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT s.notification_enabled
-                FROM users u
-                JOIN user_settings s ON u.id = s.user_id
-                WHERE u.telegram_id = ?
-            ''', (telegram_id,))
-            
-            result = cursor.fetchone()
+            result = conn.execute(_SQL_NOTIFICATION_STATUS, (telegram_id,)).fetchone()
             if result:
                 return bool(result['notification_enabled'])
             return None
@@ -412,19 +646,7 @@ class Database:
     def get_notification_times(self, telegram_id: int) -> Optional[Dict[str, str]]:
         """Получить времена автоуведомлений пользователя."""
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                '''
-                SELECT s.notification_daily_time,
-                       s.notification_weekly_time,
-                       s.notification_monthly_time
-                FROM users u
-                JOIN user_settings s ON u.id = s.user_id
-                WHERE u.telegram_id = ?
-                ''',
-                (telegram_id,)
-            )
-            row = cursor.fetchone()
+            row = conn.execute(_SQL_NOTIFICATION_TIMES, (telegram_id,)).fetchone()
             if not row:
                 return None
             return {
@@ -449,22 +671,20 @@ class Database:
         if not column:
             raise ValueError(f"Unsupported period_type: {period_type}")
 
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-            user = cursor.fetchone()
+        with self.get_connection(write=True) as conn:
+            user = conn.execute(_SQL_GET_USER_ID, (telegram_id,)).fetchone()
 
             if not user:
                 logger.warning(f"Пользователь {telegram_id} не найден")
                 return False
 
-            cursor.execute(
+            cursor = conn.execute(
                 f'''
                 UPDATE user_settings
-                SET {column} = ?, updated_at = ?
+                SET {column} = ?, updated_at = {_SQL_NOW_MOSCOW}
                 WHERE user_id = ?
                 ''',
-                (time_value, now_moscow(), user['id'])
+                (time_value, user['id'])
             )
 
             updated = cursor.rowcount > 0
@@ -479,32 +699,42 @@ class Database:
         - запись в users
         - связанные настройки и логи запросов.
         """
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-
-            # Получаем внутренний id пользователя
-            cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-            user = cursor.fetchone()
+        with self.get_connection(write=True) as conn:
+            # Логи и настройки удаляем подзапросом (в старых БД внешние ключи
+            # могли быть созданы без каскада), сам пользователь — одним
+            # DELETE ... RETURNING без предварительного SELECT
+            conn.execute(
+                "DELETE FROM request_logs WHERE user_id = "
+                "(SELECT id FROM users WHERE telegram_id = ?)",
+                (telegram_id,)
+            )
+            conn.execute(
+                "DELETE FROM user_settings WHERE user_id = "
+                "(SELECT id FROM users WHERE telegram_id = ?)",
+                (telegram_id,)
+            )
+            row = conn.execute(
+                "DELETE FROM users WHERE telegram_id = ? RETURNING id",
+                (telegram_id,)
+            ).fetchone()
 
-            if not user:
+            if not row:
                 logger.info(f"Попытка удаления несуществующего пользователя {telegram_id}")
                 return False
 
-            user_id = user["id"]
-
-            # Сначала удаляем логи запросов и настройки (на случай отсутствия каскадов)
-            cursor.execute("DELETE FROM request_logs WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM user_settings WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            logger.info(f"Пользователь {telegram_id} (id={row[0]}) успешно удалён из БД")
+            return True
 
-            deleted = cursor.rowcount > 0
-            if deleted:
-                logger.info(f"Пользователь {telegram_id} (id={user_id}) успешно удалён из БД")
 
-            return deleted
+# Кеш экземпляров по пути к файлу: повторный вызов init_database
+# (например, из обработчика /start) не пересоздаёт пул и не гоняет DDL
+_instances: Dict[str, Database] = {}
 
 
-# Создаем синглтон экземпляр БД
 def init_database(db_path: str) -> Database:
-    """Инициализация базы данных"""
-    return Database(db_path)
\ No newline at end of file
+    """Инициализация базы данных (один экземпляр на путь)"""
+    db = _instances.get(db_path)
+    if db is None:
+        db = Database(db_path)
+        _instances[db_path] = db
+    return db
\ No newline at end of file
@@ -1,13 +1,20 @@
+import asyncio
 import logging
 import os
+import re
 import tempfile
+import time
+from contextlib import suppress
+from datetime import date, datetime, timedelta
+
+import httpx
 from openpyxl.styles import Font
 from telegram import Update, ReplyKeyboardRemove, LabeledPrice
-from telegram.ext import ContextTypes, ConversationHandler, MessageHandler, filters, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, ContextTypes, ConversationHandler, MessageHandler, filters, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler
 from telegram.constants import ParseMode
 
 from moysklad_api import MoyskladAPI, get_period_dates, AnalyticsCalculator
-from datetime import datetime, timedelta
 from database import Database
 from security import security
 from keyboards import (
@@ -32,6 +39,433 @@ logger = logging.getLogger(__name__)
 REGISTRATION, API_TOKEN = range(2)
 WAITING_REMINDER_DATE = 'WAITING_REMINDER_DATE'
 
+# Разбор произвольного периода: strptime на каждый ввод компилирует формат
+# заново, поэтому даты вида ДД.ММ.ГГГГ матчим заранее скомпилированными
+# регулярками и собираем date() напрямую. День и месяц допускают одну
+# цифру (1.1.2026), как и strptime с %d.%m.%Y
+_DATE_RE = re.compile(r'^\s*(\d{1,2})\.(\d{1,2})\.(\d{4})\s*$')
+_RANGE_RE = re.compile(r'^\s*(\d{1,2})\.(\d{1,2})\.(\d{4})\s*-\s*(\d{1,2})\.(\d{1,2})\.(\d{4})\s*$')
+
+
+def _parse_period_input(user_input: str) -> tuple:
+    """Разбор периода вида `ДД.ММ.ГГГГ` или `ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`.
+
+    Возвращает (date_from, date_to, period_name), даты в ISO-формате.
+    Бросает ValueError на неверном формате или несуществующей дате.
+    """
+    if (m := _RANGE_RE.match(user_input)) is not None:
+        # Диапазон дат: date() нужен только для календарной валидации,
+        # ISO-строки собираем из групп, дополняя день и месяц нулями
+        d1, m1, y1, d2, m2, y2 = m.groups()
+        date(int(y1), int(m1), int(d1))
+        date(int(y2), int(m2), int(d2))
+
+        date_from = f"{y1}-{m1:>02}-{d1:>02}"
+        date_to = f"{y2}-{m2:>02}-{d2:>02}"
+
+        # ISO-строки YYYY-MM-DD сравниваются хронологически и как строки
+        if date_from > date_to:
+            date_from, date_to = date_to, date_from
+
+        return date_from, date_to, user_input
+
+    if (m := _DATE_RE.match(user_input)) is not None:
+        # Одна дата
+        d, mo, y = m.groups()
+        date(int(y), int(mo), int(d))
+        iso = f"{y}-{mo:>02}-{d:>02}"
+        return iso, iso, user_input
+
+    raise ValueError(f"неверный формат периода: {user_input!r}")
+
+# Фильтр для ввода API-токена: валидация выполняется роутером PTB до
+# планирования корутины обработчика, мусорный ввод до него не доходит
+TOKEN_FILTER_PATTERN = r'^\s*[A-Za-z0-9_\-]{20,}\s*$'
+
+# Названия отчетов (родительный падеж) для текстов про произвольный период
+_REPORT_NAMES = {
+    'retail_sales': 'розничных продаж',
+    'customer_orders': 'заказов покупателей',
+    'demand': 'отгрузок',
+    'combined_report': 'объединенного отчета'
+}
+
+# Маппинг текста кнопок на типы периодов
+_PERIOD_MAPPING = {
+    '📅 Сегодня': 'today',
+    '📆 Неделя': 'week',
+    '📈 Месяц': 'month',
+    '🗓 Произвольный период': 'custom'
+}
+
+# Диспетчеризация детальных отчетов: тип -> (метод API, форматтер,
+# шаблон "нет данных"). Таблица вместо четырех почти одинаковых веток
+_REPORT_DISPATCH = {
+    'retail_sales': (
+        'get_retail_sales_report', 'format_retail_report',
+        '📭 Нет розничных продаж за период: {}',
+    ),
+    'customer_orders': (
+        'get_sales_report', 'format_report',
+        '📭 Нет заказов покупателей за период: {}',
+    ),
+    'demand': (
+        'get_demand_report', 'format_demand_report',
+        '📭 Нет отгрузок за период: {}',
+    ),
+    'combined_report': (
+        'get_combined_sales_report', 'format_combined_report',
+        '📭 Нет данных для объединенного отчета за период: {}',
+    ),
+}
+
+# Ключи context.user_data, любой из которых означает, что пользователь
+# находится в потоке детальных отчетов
+_DETAILED_FLOW_KEYS = frozenset({
+    'waiting_for_detailed_period',
+    'detailed_report_type',
+    'current_report_type',
+    'waiting_custom_period_type',
+    'expecting_custom_period_for',
+})
+
+# Заготовки полос для текстовой диаграммы продаж: при длине шкалы 20
+# возможна всего 21 длина полосы, незачем собирать строки на каждый отчет
+_BAR_LENGTH = 20
+_BAR_FULL = tuple('█' * i for i in range(_BAR_LENGTH + 1))
+_BAR_EMPTY = tuple('░' * i for i in range(_BAR_LENGTH + 1))
+_BAR_AXIS = '1' + ' ' * (_BAR_LENGTH - 2) + str(_BAR_LENGTH)
+
+# Временные ключи сценариев в context.user_data. Сбрасываем их адресно:
+# полный clear() выкидывал бы и кеш строки пользователя (_user_row),
+# после чего первый же следующий обработчик шел бы в БД заново
+_TRANSIENT_KEYS = frozenset({
+    'user_id',
+    'phone',
+    'waiting_for_token',
+    'custom_period',
+    'current_report_type',
+    'detailed_report_type',
+    'waiting_for_detailed_period',
+    'expecting_custom_period_for',
+    'waiting_custom_period_type',
+    'detailed_custom_period',
+    'awaiting_notification_time_type',
+})
+
+
+def _clear_transient_state(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сброс временного состояния сценариев без потери кешей"""
+    for key in _TRANSIENT_KEYS:
+        context.user_data.pop(key, None)
+
+
+# Ожидаемые сбои внешних сервисов (таймауты и обрывы httpx, ошибки Telegram):
+# логируем одной строкой без traceback — exc_info=True на горячем пути ошибок
+# (например, при rate limit МойСклад) заставляет Python собирать полный стек
+# и держать кадры живыми. Полный traceback оставляем только для
+# действительно неожиданных исключений.
+_TRANSIENT_ERRORS = (httpx.HTTPError, asyncio.TimeoutError, TelegramError)
+
+# TTL кеша строки пользователя в context.user_data: почти каждый обработчик
+# начинается с get_user, а за одно взаимодействие их срабатывает несколько —
+# держим строку 30 секунд вместо похода в БД на каждое нажатие
+_USER_CACHE_KEY = '_user_row'
+_USER_CACHE_TTL = 30.0  # секунд
+
+
+async def _get_cached_user(db: Database, user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """Строка пользователя с коротким кешем в context.user_data.
+
+    Чтение из БД уходит в поток через asyncio.to_thread, чтобы не блокировать
+    event loop. После изменения данных пользователя кеш нужно сбрасывать
+    через _invalidate_user_cache.
+    """
+    cached = context.user_data.get(_USER_CACHE_KEY)
+    if cached is not None:
+        user_row, expires_at = cached
+        if time.monotonic() < expires_at:
+            return user_row
+
+    user_row = await asyncio.to_thread(db.get_user, user_id)
+    context.user_data[_USER_CACHE_KEY] = (user_row, time.monotonic() + _USER_CACHE_TTL)
+    return user_row
+
+
+def _invalidate_user_cache(context: ContextTypes.DEFAULT_TYPE):
+    """Сброс кеша строки пользователя (после add_user/update_*/delete_user)."""
+    context.user_data.pop(_USER_CACHE_KEY, None)
+
+
+# Кеш расшифрованных API-токенов: Fernet-дешифровка — CPU-работа под GIL,
+# повторять её на каждое нажатие одного и того же пользователя незачем
+_TOKEN_CACHE: dict[int, tuple[str, float]] = {}
+_TOKEN_CACHE_TTL = 300.0  # секунд
+_TOKEN_CACHE_MAX = 512  # защита от роста без границ
+
+
+async def _get_api_token(db: Database, user_id: int) -> str:
+    """Расшифрованный API-токен пользователя с коротким кешем в памяти.
+
+    Промах достает зашифрованный токен отдельным узким SELECT (строка
+    пользователя в кеше его больше не содержит) и уводит дешифровку в
+    worker-поток; пустой результат (нет токена или ошибка расшифровки)
+    не кешируется, чтобы обновление токена сработало сразу.
+    """
+    cached = _TOKEN_CACHE.get(user_id)
+    if cached is not None:
+        api_token, expires_at = cached
+        if time.monotonic() < expires_at:
+            return api_token
+
+    encrypted_token = await _run(db.get_user_token, user_id)
+    if not encrypted_token:
+        return ""
+
+    api_token = await _run(security.decrypt, encrypted_token)
+    if api_token:
+        if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+            # dict упорядочен по вставке — выкидываем самую старую запись
+            _TOKEN_CACHE.pop(next(iter(_TOKEN_CACHE)), None)
+        _TOKEN_CACHE[user_id] = (api_token, time.monotonic() + _TOKEN_CACHE_TTL)
+    return api_token
+
+
+def _invalidate_token_cache(user_id: int):
+    """Сброс кеша расшифрованного токена (после смены или удаления)."""
+    _TOKEN_CACHE.pop(user_id, None)
+
+
+# Фоновые задачи (удаление служебных сообщений, закрытие клиентов):
+# цикл событий держит только слабые ссылки на таски, поэтому без своей
+# ссылки задача может быть собрана GC до того, как выполнится
+_BACKGROUND_TASKS: set = set()
+
+
+def _spawn(coro) -> None:
+    """create_task с удержанием ссылки до завершения задачи."""
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+# Один MoyskladAPI (с его keep-alive HTTP-клиентом) на пользователя:
+# иначе каждый отчет заново строит пул соединений и проходит TLS-рукопожатие
+_API_CLIENTS: dict[int, MoyskladAPI] = {}
+_API_CLIENTS_MAX = 512  # каждый клиент держит пул сокетов — рост без границ недопустим
+
+
+def _get_api(user_id: int, api_token: str) -> MoyskladAPI:
+    """Закешированный API-клиент пользователя; пересоздается при смене токена."""
+    api = _API_CLIENTS.get(user_id)
+    if api is not None:
+        if api.api_token == api_token:
+            return api
+        # Токен сменился — старый клиент аккуратно закрываем в фоне
+        _spawn(api.aclose())
+        _API_CLIENTS.pop(user_id, None)
+
+    if len(_API_CLIENTS) >= _API_CLIENTS_MAX:
+        # Вытесняем самую старую запись вместе с ее соединениями
+        oldest = _API_CLIENTS.pop(next(iter(_API_CLIENTS)))
+        _spawn(oldest.aclose())
+
+    api = MoyskladAPI(api_token)
+    _API_CLIENTS[user_id] = api
+    return api
+
+
+async def close_api_clients(application=None) -> None:
+    """Закрытие всех закешированных API-клиентов (post_shutdown-хук бота)."""
+    clients = list(_API_CLIENTS.values())
+    _API_CLIENTS.clear()
+    for api in clients:
+        try:
+            await api.aclose()
+        except Exception:
+            pass
+
+
+# Статические тексты меню и подсказок: собираются один раз при импорте,
+# а не заново при каждом нажатии кнопки
+_MSG_MAIN_MENU = (
+    "📱 *Главное меню*\n\n"
+    "Выберите нужный раздел:"
+)
+
+_MSG_START_REGISTRATION = (
+    "🔐 *Регистрация в боте МойСклад*\n\n"
+    "*Для доступа к статистике необходимо:*\n\n"
+    "1. 📱 *Предоставить номер телефона*\n"
+    "   - Нажмите кнопку 'Поделиться номером' ниже\n\n"
+    "2. 🔑 *Указать API-токен МойСклад*\n"
+    "   - Зайдите в МойСклад → Настройки → Безопасность\n"
+    "   - Создайте токен с правами на чтение\n"
+    "   - Скопируйте и вставьте в бот\n\n"
+    "3. ❌ *При необходимости вы можете отменить регистрацию кнопкой "
+    "'Отмена регистрации' или командой /cancel*\n\n"
+    "*Ваши данные будут защищены:*\n"
+    "• Номер телефона хранится в зашифрованном виде\n"
+    "• API-токен шифруется перед сохранением\n"
+    "• Данные не передаются третьим лицам\n\n"
+    "Нажмите кнопку ниже, чтобы поделиться номером:"
+)
+
+_MSG_UPDATE_TOKEN = (
+    "🔑 *Обновление API-токена*\n\n"
+    "Введите новый API-токен МойСклад:\n\n"
+    "1. Зайдите в МойСклад → Настройки → Безопасность\n"
+    "2. Создайте новый токен\n"
+    "3. Вставьте его в чат\n\n"
+    "Для отмены нажмите /cancel"
+)
+
+_MSG_REPORTS_MENU = (
+    "📊 *Отчеты*\n\n"
+    "Выберите период для получения статистики:"
+)
+
+_MSG_ANALYTICS_MENU = (
+    "📈 *Аналитика*\n\n"
+    "Сравнение периодов и детальная аналитика:"
+)
+
+_MSG_DETAILED_MENU = (
+    "📊 *Детализированные отчеты*\n\n"
+    "Выберите тип отчета:"
+)
+
+_MSG_RETAIL_MENU = (
+    "🛍 *Розничные продажи*\n\n"
+    "Выберите период для отчета:"
+)
+
+_MSG_DEMAND_MENU = (
+    "🚚 *Отгрузки*\n\n"
+    "Выберите период для отчета:"
+)
+
+_MSG_ORDERS_MENU = (
+    "📦 *Заказы покупателей*\n\n"
+    "Выберите период для отчета:"
+)
+
+_MSG_COMBINED_MENU = (
+    "📊 *Объединенный отчет*\n\n"
+    "Выберите период для отчета:"
+)
+
+_MSG_NEED_REGISTRATION = "❌ Сначала необходимо зарегистрироваться."
+
+_MSG_NEED_REGISTRATION_START = (
+    "❌ Сначала необходимо зарегистрироваться.\n"
+    "Используйте /start для регистрации."
+)
+
+_MSG_NEED_TOKEN = "❌ Сначала необходимо зарегистрироваться и указать API-токен."
+
+_MSG_NEED_TOKEN_START = (
+    "❌ Сначала необходимо зарегистрироваться и указать API-токен.\n"
+    "Используйте /start для регистрации."
+)
+
+_MSG_DECRYPT_ERROR = "❌ Ошибка расшифровки токена. Обновите API-токен."
+
+# Тексты ошибок формата периода: один и тот же литерал повторялся в
+# нескольких обработчиках — держим его в одном месте
+_ERR_BAD_DATE = (
+    "❌ Неверный формат даты.\n"
+    "Используйте формат: `ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`"
+)
+_ERR_BAD_DATE_EXAMPLE = _ERR_BAD_DATE + "\nПример: `01.01.2026 - 31.01.2026`"
+_ERR_BAD_DATE_RETRY = _ERR_BAD_DATE + "\n\nПопробуйте снова:"
+
+# Общая часть подсказки произвольного периода: выше добавляется только заголовок
+_MSG_CUSTOM_PERIOD_BODY = (
+    "Введите период в формате:\n"
+    "`ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`\n\n"
+    "Пример: `01.01.2026 - 31.01.2026`\n\n"
+    "Или введите одну дату для отчета за день: `01.01.2026`"
+)
+
+# Хвосты сообщения /notifications: статичны для каждого из двух состояний,
+# в заголовок подставляются только времена отправки
+_NOTIF_TAIL_ENABLED = (
+    "*Вы получаете автоматические отчеты:*\n"
+    "• Ежедневно - статистика за вчера\n"
+    "• По понедельникам - статистика за неделю\n"
+    "• 1 числа месяца - отчет за прошлый месяц\n\n"
+    "Используйте кнопки ниже для управления временем."
+)
+
+_NOTIF_TAIL_DISABLED = (
+    "*При включении вы будете получать:*\n"
+    "• Ежедневно - статистика за вчера\n"
+    "• По понедельникам - статистика за неделю\n"
+    "• 1 числа месяца - отчет за прошлый месяц\n\n"
+    "Можно заранее настроить время для каждого типа отчета."
+)
+
+_MSG_CUSTOM_PERIOD_PROMPT = "🗓 *Произвольный период*\n\n" + _MSG_CUSTOM_PERIOD_BODY
+
+# Готовые подсказки по типу отчета: меняется только заголовок,
+# незачем склеивать строку на каждое нажатие
+_CUSTOM_PERIOD_PROMPTS = {
+    report_type: f"🗓 *Произвольный период для {name}*\n\n" + _MSG_CUSTOM_PERIOD_BODY
+    for report_type, name in _REPORT_NAMES.items()
+}
+_CUSTOM_PERIOD_PROMPT_DEFAULT = (
+    "🗓 *Произвольный период для отчета*\n\n" + _MSG_CUSTOM_PERIOD_BODY
+)
+
+
+async def _safe_delete(bot, chat_id: int, message_id: int) -> None:
+    """Фоновое удаление служебного сообщения: неудача не важна.
+
+    Глушим только ошибки Bot API (уже удалено, нет прав, сеть) —
+    программные ошибки и CancelledError должны всплывать, а не
+    исчезать в фоне.
+    """
+    with suppress(TelegramError):
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+
+async def _require_api_token(db: Database, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             reject_markup, reject_msg: str = _MSG_NEED_REGISTRATION):
+    """Общий преамбул отчетных обработчиков: регистрация + расшифрованный токен.
+
+    Возвращает (user_data, api_token). При отказе сам отвечает пользователю
+    (reject_msg для незарегистрированных, ошибка расшифровки — для проблем с
+    токеном) и возвращает api_token = "".
+    """
+    user = update.effective_user
+    user_data = await _get_cached_user(db, user.id, context)
+
+    if not user_data or not user_data.get('has_token'):
+        await update.message.reply_text(reject_msg, reply_markup=reject_markup)
+        return user_data, ""
+
+    api_token = await _get_api_token(db, user.id)
+
+    if not api_token:
+        await update.message.reply_text(
+            _MSG_DECRYPT_ERROR,
+            reply_markup=get_settings_keyboard()
+        )
+        return user_data, ""
+
+    return user_data, api_token
+
+
+async def _run(fn, *args, **kwargs):
+    """Выполнение блокирующего вызова (SQLite, Fernet) в worker-потоке.
+
+    Синхронные обращения к БД и шифрованию из async-обработчиков блокируют
+    общий event loop PTB; через to_thread остальные пользователи
+    обслуживаются, пока идёт запрос.
+    """
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
 
 def require_subscription(mode: str = "full"):
     """
@@ -73,25 +507,76 @@ def require_subscription(mode: str = "full"):
     return decorator
 
 
+# Кнопки меню, доступные только зарегистрированным пользователям с токеном,
+# и ответ, который раньше отправлял каждый обработчик сам. Проверка вынесена
+# в прехендлер группы -1: одна строка пользователя на апдейт и быстрый отказ
+# до запуска основного обработчика.
+_GATED_BUTTONS = {
+    "📊 Быстрый отчет": _MSG_NEED_REGISTRATION_START,
+    "📊 Детальные отчеты": _MSG_NEED_TOKEN,
+    "🛍 Розничные продажи": _MSG_NEED_REGISTRATION,
+    "📦 Заказы покупателей": _MSG_NEED_REGISTRATION,
+    "🚚 Отгрузки": _MSG_NEED_REGISTRATION,
+    "📊 Объединенный отчет": _MSG_NEED_REGISTRATION,
+    "📈 Аналитика": _MSG_NEED_TOKEN_START,
+    "📈 Сегодня vs Вчера": _MSG_NEED_TOKEN,
+    "📅 Год назад": _MSG_NEED_TOKEN,
+    "📆 Неделя vs Прошлая": _MSG_NEED_TOKEN,
+    "📊 Месяц vs Прошлый": _MSG_NEED_TOKEN,
+    "🧾 Топ-20 товаров": _MSG_NEED_REGISTRATION,
+    "⚙️ Настройки": "❌ Вы еще не зарегистрированы. Используйте /start для регистрации.",
+}
+
+
+class RegistrationGate:
+    """Прехендлер группы -1: резолвит пользователя один раз на апдейт.
+
+    Строка пользователя попадает в кеш context.user_data, поэтому
+    обработчики группы 0 берут ее оттуда без похода в БД. Для кнопок из
+    _GATED_BUTTONS незарегистрированный пользователь получает отказ сразу,
+    до запуска основного обработчика.
+    """
+
+    __slots__ = ('db',)
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def precheck(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = update.message
+        user = update.effective_user
+        if message is None or user is None:
+            return
+
+        user_data = await _get_cached_user(self.db, user.id, context)
+
+        reply = _GATED_BUTTONS.get(message.text)
+        if reply is not None and not (user_data and user_data.get('has_token')):
+            await message.reply_text(reply, reply_markup=get_main_menu(False))
+            raise ApplicationHandlerStop
+
+
 class AuthHandlers:
     """Обработчики аутентификации"""
 
+    __slots__ = ('db',)
+
     def __init__(self, db: Database):
         self.db = db
 
     async def start_auth(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало процесса регистрации"""
         user = update.effective_user
-        logger.info(f"Начало регистрации для пользователя: {user.id}")
+        logger.info("Начало регистрации для пользователя: %s", user.id)
 
         # Проверяем, зарегистрирован ли уже пользователь
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
         # Проверяем полную регистрацию (телефон + токен)
-        is_fully_registered = user_data and user_data.get('phone_number') and user_data.get('api_token_encrypted')
+        is_fully_registered = user_data and user_data.get('phone_number') and user_data.get('has_token')
 
         if is_fully_registered:
-            logger.info(f"Пользователь {user.id} уже зарегистрирован")
+            logger.info("Пользователь %s уже зарегистрирован", user.id)
 
             # Формируем информацию о пользователе
             phone = user_data.get('phone_number', 'Не указан')
@@ -110,9 +595,9 @@ class AuthHandlers:
         # Проверяем, есть ли частичная регистрация (только телефон)
         has_phone = user_data and user_data.get('phone_number')
 
-        if has_phone and not user_data.get('api_token_encrypted'):
+        if has_phone and not user_data.get('has_token'):
             # Есть телефон, но нет токена - запрашиваем токен
-            logger.info(f"У пользователя {user.id} есть телефон, но нет токена")
+            logger.info("У пользователя %s есть телефон, но нет токена", user.id)
 
             phone = user_data.get('phone_number', 'Не указан')
 
@@ -135,24 +620,10 @@ class AuthHandlers:
             return API_TOKEN
 
         # Полная регистрация - запрашиваем номер телефона
-        logger.info(f"Начало полной регистрации для пользователя {user.id}")
+        logger.info("Начало полной регистрации для пользователя %s", user.id)
 
         await update.message.reply_text(
-            "🔐 *Регистрация в боте МойСклад*\n\n"
-            "*Для доступа к статистике необходимо:*\n\n"
-            "1. 📱 *Предоставить номер телефона*\n"
-            "   - Нажмите кнопку 'Поделиться номером' ниже\n\n"
-            "2. 🔑 *Указать API-токен МойСклад*\n"
-            "   - Зайдите в МойСклад → Настройки → Безопасность\n"
-            "   - Создайте токен с правами на чтение\n"
-            "   - Скопируйте и вставьте в бот\n\n"
-            "3. ❌ *При необходимости вы можете отменить регистрацию кнопкой "
-            "'Отмена регистрации' или командой /cancel*\n\n"
-            "*Ваши данные будут защищены:*\n"
-            "• Номер телефона хранится в зашифрованном виде\n"
-            "• API-токен шифруется перед сохранением\n"
-            "• Данные не передаются третьим лицам\n\n"
-            "Нажмите кнопку ниже, чтобы поделиться номером:",
+            _MSG_START_REGISTRATION,
             reply_markup=get_phone_keyboard(),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -165,16 +636,12 @@ class AuthHandlers:
 
         if update.message.contact:
             phone_number = update.message.contact.phone_number
-            # Маскируем номер в логах, чтобы не хранить полные PII
-            masked_phone = (
-                f"{phone_number[:3]}***{phone_number[-2:]}"
-                if phone_number and len(phone_number) >= 5
-                else "***"
-            )
-            logger.info(f"Номер телефона получен для пользователя {user.id}: {masked_phone}")
+            # Сам номер в логи не пишем — PII там не нужен
+            logger.debug("Номер телефона получен для пользователя %s", user.id)
 
             # Сохраняем/обновляем пользователя
-            user_id = self.db.add_user(user.id, phone_number)
+            user_id = await _run(self.db.add_user, user.id, phone_number)
+            _invalidate_user_cache(context)
             context.user_data['user_id'] = user_id
             context.user_data['phone'] = phone_number
 
@@ -200,15 +667,9 @@ class AuthHandlers:
     async def get_api_token(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Получение и сохранение API-токена"""
         user = update.effective_user
+        # Формат уже проверен фильтром TOKEN_FILTER_PATTERN в роутере
         api_token = update.message.text.strip()
 
-        # Базовая валидация токена
-        if len(api_token) < 20:
-            await update.message.reply_text(
-                "❌ Токен слишком короткий. Пожалуйста, проверьте правильность токена и введите его снова:"
-            )
-            return API_TOKEN
-
         try:
             # Проверяем токен через API МойСклад до сохранения
             api = MoyskladAPI(api_token)
@@ -220,20 +681,26 @@ class AuthHandlers:
                 return API_TOKEN
 
             # Шифруем токен
-            encrypted_token = security.encrypt(api_token)
+            encrypted_token = await _run(security.encrypt, api_token)
 
             # Сохраняем в базе данных
-            success = self.db.update_user_token(user.id, encrypted_token)
+            success = await _run(self.db.update_user_token, user.id, encrypted_token)
 
             if success:
-                logger.info(f"API-токен сохранен для пользователя {user.id}")
+                logger.info("API-токен сохранен для пользователя %s", user.id)
+                _invalidate_user_cache(context)
+                _invalidate_token_cache(user.id)
 
                 # Обновляем время активности
+                # Теперь это только добавление в буфер — worker-поток не нужен
                 self.db.update_last_active(user.id)
 
-                # Если у пользователя еще не настроена подписка — запускаем триал
+                # Если у пользователя еще не настроена подписка — запускаем триал.
+                # Строку пользователя читаем один раз через кеш; дату окончания
+                # свежего триала знаем сами, повторный SELECT не нужен
+                expires_at = None
                 try:
-                    db_user = self.db.get_user(user.id)
+                    db_user = await _get_cached_user(self.db, user.id, context)
                     sub_status = (db_user.get('subscription_status') or 'none').lower() if db_user else 'none'
                     if sub_status == 'none':
                         now = now_moscow().replace(microsecond=0)
@@ -244,24 +711,24 @@ class AuthHandlers:
                             expires_at=trial_end,
                             trial_started_at=now
                         )
-                        logger.info(f"Trial subscription started for user {user.id} until {trial_end}")
+                        _invalidate_user_cache(context)
+                        expires_at = trial_end
+                        logger.info("Trial subscription started for user %s until %s", user.id, trial_end)
+                    elif db_user:
+                        expires_at = db_user.get("subscription_expires_at")
                 except Exception as e:
-                    logger.error(f"Ошибка при установке триальной подписки для пользователя {user.id}: {e}")
+                    logger.error("Ошибка при установке триальной подписки для пользователя %s: %s", user.id, e)
 
                 phone = context.user_data.get('phone', 'не указан')
 
                 trial_info = ""
-                try:
-                    db_user = self.db.get_user(user.id)
-                    if db_user and db_user.get("subscription_expires_at"):
-                        trial_info = (
-                            f"\n\n🆓 *Пробный период:* 1 месяц бесплатно до "
-                            f"`{db_user['subscription_expires_at']}`\n"
-                            f"После этого стоимость подписки составит {config.SUBSCRIPTION_PRICE_RUB}₽ в месяц.\n"
-                            f"Управление подпиской: кнопка *\"💳 Подписка\"* в главном меню."
-                        )
-                except Exception:
-                    pass
+                if expires_at:
+                    trial_info = (
+                        f"\n\n🆓 *Пробный период:* 1 месяц бесплатно до "
+                        f"`{expires_at}`\n"
+                        f"После этого стоимость подписки составит {config.SUBSCRIPTION_PRICE_RUB}₽ в месяц.\n"
+                        f"Управление подпиской: кнопка *\"💳 Подписка\"* в главном меню."
+                    )
 
                 await update.message.reply_text(
                     "🎉 *Регистрация успешно завершена!*\n\n"
@@ -280,8 +747,16 @@ class AuthHandlers:
                 )
                 return API_TOKEN
 
-        except Exception as e:
-            logger.error(f"Ошибка сохранения токена для пользователя {user.id}: {e}")
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("Сбой внешнего сервиса при сохранении токена пользователя %s: %s", user.id, e)
+            await update.message.reply_text(
+                "❌ Произошла ошибка при сохранении токена. Попробуйте снова:",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return API_TOKEN
+
+        except Exception:
+            logger.exception("Ошибка сохранения токена для пользователя %s", user.id)
             await update.message.reply_text(
                 "❌ Произошла ошибка при сохранении токена. Попробуйте снова:",
                 reply_markup=ReplyKeyboardRemove()
@@ -289,35 +764,48 @@ class AuthHandlers:
             return API_TOKEN
 
         # Очищаем временные данные
-        context.user_data.pop('user_id', None)
-        context.user_data.pop('phone', None)
+        _clear_transient_state(context)
 
         return ConversationHandler.END
 
+    async def reject_invalid_token(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Ответ на ввод, не прошедший фильтр токена при регистрации"""
+        await update.message.reply_text(
+            "❌ Токен слишком короткий. Пожалуйста, проверьте правильность токена и введите его снова:"
+        )
+        return API_TOKEN
+
+    async def reject_invalid_token_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Ответ на ввод, не прошедший фильтр токена при обновлении"""
+        await update.message.reply_text(
+            "❌ Токен слишком короткий. Пожалуйста, введите валидный API-токен:"
+        )
+        return 'WAITING_TOKEN'
+
     async def cancel_registration(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отмена регистрации"""
         user = update.effective_user
 
         # Проверяем статус пользователя
-        user_data = self.db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = user_data and user_data.get('has_token')
 
         await update.message.reply_text(
             "❌ Регистрация отменена.",
             reply_markup=get_main_menu(is_registered)  # ✅ Исправлено
         )
 
-        # Очищаем временные данные
-        context.user_data.clear()
+        # Очищаем временные данные сценария, не трогая кеши
+        _clear_transient_state(context)
 
         return ConversationHandler.END
 
     async def show_settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать настройки"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
                 "❌ Вы еще не зарегистрированы. Используйте /start для регистрации.",
                 reply_markup=get_main_menu()
@@ -331,7 +819,7 @@ class AuthHandlers:
             f"⚙️ *Ваши настройки*\n\n"
             f"📱 Телефон: `{phone_number}`\n"
             f"📅 Зарегистрирован: `{created_at}`\n"
-            f"🔐 API-токен: {'✅ Сохранен' if user_data.get('api_token_encrypted') else '❌ Отсутствует'}\n\n"
+            f"🔐 API-токен: {'✅ Сохранен' if user_data.get('has_token') else '❌ Отсутствует'}\n\n"
             f"Используйте кнопки ниже для управления:"
         )
 
@@ -346,12 +834,7 @@ class AuthHandlers:
         user = update.effective_user
 
         await update.message.reply_text(
-            "🔑 *Обновление API-токена*\n\n"
-            "Введите новый API-токен МойСклад:\n\n"
-            "1. Зайдите в МойСклад → Настройки → Безопасность\n"
-            "2. Создайте новый токен\n"
-            "3. Вставьте его в чат\n\n"
-            "Для отмены нажмите /cancel",
+            _MSG_UPDATE_TOKEN,
             reply_markup=ReplyKeyboardRemove(),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -362,14 +845,9 @@ class AuthHandlers:
     async def process_token_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка нового токена"""
         user = update.effective_user
+        # Формат уже проверен фильтром TOKEN_FILTER_PATTERN в роутере
         api_token = update.message.text.strip()
 
-        if len(api_token) < 20:
-            await update.message.reply_text(
-                "❌ Токен слишком короткий. Пожалуйста, введите валидный API-токен:"
-            )
-            return 'WAITING_TOKEN'
-
         try:
             # Проверяем токен через API МойСклад до сохранения
             api = MoyskladAPI(api_token)
@@ -380,10 +858,12 @@ class AuthHandlers:
                 )
                 return 'WAITING_TOKEN'
 
-            encrypted_token = security.encrypt(api_token)
-            success = self.db.update_user_token(user.id, encrypted_token)
+            encrypted_token = await _run(security.encrypt, api_token)
+            success = await _run(self.db.update_user_token, user.id, encrypted_token)
 
             if success:
+                _invalidate_user_cache(context)
+                _invalidate_token_cache(user.id)
                 await update.message.reply_text(
                     "✅ API-токен успешно обновлен!",
                     reply_markup=get_main_menu()
@@ -394,8 +874,15 @@ class AuthHandlers:
                     reply_markup=get_main_menu()
                 )
 
-        except Exception as e:
-            logger.error(f"Ошибка обновления токена: {e}")
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("Сбой внешнего сервиса при обновлении токена: %s", e)
+            await update.message.reply_text(
+                "❌ Произошла ошибка. Попробуйте позже.",
+                reply_markup=get_main_menu()
+            )
+
+        except Exception:
+            logger.exception("Ошибка обновления токена")
             await update.message.reply_text(
                 "❌ Произошла ошибка. Попробуйте позже.",
                 reply_markup=get_main_menu()
@@ -408,7 +895,7 @@ class AuthHandlers:
         """Полное удаление аккаунта пользователя из БД"""
         user = update.effective_user
 
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
         if not user_data:
             await update.message.reply_text(
                 "ℹ️ Ваш аккаунт уже не найден в базе данных.",
@@ -416,7 +903,9 @@ class AuthHandlers:
             )
             return
 
-        deleted = self.db.delete_user(user.id)
+        deleted = await _run(self.db.delete_user, user.id)
+        _invalidate_user_cache(context)
+        _invalidate_token_cache(user.id)
 
         if deleted:
             await update.message.reply_text(
@@ -435,18 +924,19 @@ class AuthHandlers:
 class MenuHandlers:
     """Обработчики меню"""
 
+    __slots__ = ('db',)
+
     def __init__(self, db: Database):
         self.db = db
 
     async def show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать главное меню"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = user_data and user_data.get('has_token')
 
         await update.message.reply_text(
-            "📱 *Главное меню*\n\n"
-            "Выберите нужный раздел:",
+            _MSG_MAIN_MENU,
             reply_markup=get_main_menu(is_registered),  # ✅ ПРАВИЛЬНО
             parse_mode=ParseMode.MARKDOWN
         )
@@ -454,9 +944,9 @@ class MenuHandlers:
     async def show_subscription_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать информацию о подписке и ссылку на оплату"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
                 "❌ Вы еще не зарегистрированы. Сначала пройдите регистрацию через /start.",
                 reply_markup=get_main_menu(False)
@@ -537,20 +1027,18 @@ class MenuHandlers:
     async def show_reports_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню отчетов"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = user_data and user_data.get('has_token')
 
         if not is_registered:
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться и указать API-токен.\n"
-                "Используйте /start для регистрации.",
+                _MSG_NEED_TOKEN_START,
                 reply_markup=get_main_menu(False)
             )
             return
 
         await update.message.reply_text(
-            "📊 *Отчеты*\n\n"
-            "Выберите период для получения статистики:",
+            _MSG_REPORTS_MENU,
             reply_markup=get_report_keyboard(),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -559,20 +1047,18 @@ class MenuHandlers:
     async def show_analytics_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню аналитики"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = user_data and user_data.get('has_token')
 
         if not is_registered:
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться и указать API-токен.\n"
-                "Используйте /start для регистрации.",
+                _MSG_NEED_TOKEN_START,
                 reply_markup=get_main_menu(False)
             )
             return
 
         await update.message.reply_text(
-            "📈 *Аналитика*\n\n"
-            "Сравнение периодов и детальная аналитика:",
+            _MSG_ANALYTICS_MENU,
             reply_markup=get_analytics_keyboard(),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -580,12 +1066,11 @@ class MenuHandlers:
     async def handle_back(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка кнопки Назад"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = user_data and user_data.get('has_token')
 
         await update.message.reply_text(
-            "📱 *Главное меню*\n\n"
-            "Выберите нужный раздел:",
+            _MSG_MAIN_MENU,
             reply_markup=get_main_menu(is_registered),  # ✅ ПРАВИЛЬНО
             parse_mode=ParseMode.MARKDOWN
         )
@@ -610,47 +1095,46 @@ class MenuHandlers:
                                current_period: str, previous_period: str):
         """Общий метод для сравнения периодов"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-
-        if not user_data or not user_data.get('api_token_encrypted'):
-            await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться и указать API-токен.",
-                reply_markup=get_main_menu()
-            )
-            return
-
-        # Получаем и расшифровываем токен
-        encrypted_token = user_data['api_token_encrypted']
-        api_token = security.decrypt(encrypted_token)
-
+        user_data, api_token = await _require_api_token(
+            self.db, update, context, get_main_menu(), reject_msg=_MSG_NEED_TOKEN
+        )
         if not api_token:
-            await update.message.reply_text(
-                "❌ Ошибка расшифровки токена. Обновите API-токен.",
-                reply_markup=get_settings_keyboard()
-            )
             return
 
-        loading_msg = await update.message.reply_text("⏳ Сравниваем периоды...")
+        loading_msg = await update.message.reply_text("⏳ Сравниваем периоды...", disable_notification=True)
 
         try:
-            api = MoyskladAPI(api_token)
+            api = _get_api(user.id, api_token)
 
             # Получаем отчеты за оба периода
             curr_from, curr_to = get_period_dates(current_period)
             prev_from, prev_to = get_period_dates(previous_period)
 
-            current_report = await api.get_sales_report(curr_from, curr_to)
-            previous_report = await api.get_sales_report(prev_from, prev_to)
-
+            # Периоды независимы — запрашиваем оба параллельно,
+            # две сетевые задержки превращаются в одну
+            current_report, previous_report = await asyncio.gather(
+                api.get_sales_report(curr_from, curr_to),
+                api.get_sales_report(prev_from, prev_to),
+                return_exceptions=True,
+            )
+
+            # Ошибку одной из сторон приравниваем к отсутствию данных,
+            # чтобы сработала существующая ветка "нет данных за период"
+            if isinstance(current_report, BaseException):
+                logger.error("Ошибка получения текущего периода: %s", current_report)
+                current_report = None
+            if isinstance(previous_report, BaseException):
+                logger.error("Ошибка получения предыдущего периода: %s", previous_report)
+                previous_report = None
+
+            # Кнопки сравнения живут в меню аналитики, его клавиатура уже на
+            # экране — во всех ветках правим "Сравниваем..." на месте вместо
+            # пары отправка+удаление
             if current_report and previous_report:
                 # Сравниваем отчеты
                 comparison = AnalyticsCalculator.compare_reports(current_report, previous_report)
 
-                await update.message.reply_text(
-                    comparison,
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=get_analytics_keyboard()
-                )
+                await loading_msg.edit_text(comparison, parse_mode=ParseMode.MARKDOWN)
 
                 # Логируем запрос
                 self.db.log_request(
@@ -665,35 +1149,20 @@ class MenuHandlers:
                 if not previous_report:
                     error_msg += f"- Нет данных за предыдущий период ({prev_from} - {prev_to})\n"
 
-                await update.message.reply_text(
-                    error_msg,
-                    reply_markup=get_analytics_keyboard()
-                )
+                await loading_msg.edit_text(error_msg)
 
-        except Exception as e:
-            logger.error(f"Ошибка при сравнении периодов: {e}")
-            await update.message.reply_text(
-                f"❌ Ошибка: {str(e)[:100]}",
-                reply_markup=get_analytics_keyboard()
-            )
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("Сбой API при сравнении периодов: %s", e)
+            await loading_msg.edit_text(f"❌ Ошибка: {str(e)[:100]}")
 
-        finally:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=loading_msg.message_id
-                )
-            except:
-                pass
+        except Exception as e:
+            logger.exception("Ошибка при сравнении периодов")
+            await loading_msg.edit_text(f"❌ Ошибка: {str(e)[:100]}")
 
     async def ask_custom_period(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Запрос произвольного периода"""
         await update.message.reply_text(
-            "🗓 *Произвольный период*\n\n"
-            "Введите период в формате:\n"
-            "`ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`\n\n"
-            "Пример: `01.01.2026 - 31.01.2026`\n\n"
-            "Или введите одну дату для отчета за день: `01.01.2026`",
+            _MSG_CUSTOM_PERIOD_PROMPT,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=get_back_keyboard()
         )
@@ -705,25 +1174,7 @@ class MenuHandlers:
         user_input = update.message.text.strip()
 
         try:
-            if ' - ' in user_input:
-                # Диапазон дат
-                date1_str, date2_str = user_input.split(' - ')
-                date1 = datetime.strptime(date1_str.strip(), '%d.%m.%Y')
-                date2 = datetime.strptime(date2_str.strip(), '%d.%m.%Y')
-
-                # Убедимся, что первая дата раньше второй
-                if date1 > date2:
-                    date1, date2 = date2, date1
-
-                date_from = date1.strftime('%Y-%m-%d')
-                date_to = date2.strftime('%Y-%m-%d')
-                period_name = f"{date1_str} - {date2_str}"
-
-            else:
-                # Одна дата
-                date = datetime.strptime(user_input.strip(), '%d.%m.%Y')
-                date_from = date_to = date.strftime('%Y-%m-%d')
-                period_name = user_input
+            date_from, date_to, period_name = _parse_period_input(user_input)
 
             # Сохраняем период в context
             context.user_data['custom_period'] = {
@@ -739,9 +1190,7 @@ class MenuHandlers:
 
         except ValueError:
             await update.message.reply_text(
-                "❌ Неверный формат даты.\n"
-                "Используйте формат: `ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`\n"
-                "Пример: `01.01.2024 - 31.01.2024`",
+                _ERR_BAD_DATE_EXAMPLE,
                 parse_mode=ParseMode.MARKDOWN
             )
             return 'WAITING_CUSTOM_PERIOD'
@@ -749,13 +1198,10 @@ class MenuHandlers:
     async def _get_custom_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Получение отчета за произвольный период"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-
-        if not user_data or not user_data.get('api_token_encrypted'):
-            await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
-                reply_markup=get_main_menu()
-            )
+        user_data, api_token = await _require_api_token(
+            self.db, update, context, get_main_menu()
+        )
+        if not api_token:
             return
 
         period_data = context.user_data.get('custom_period', {})
@@ -766,20 +1212,10 @@ class MenuHandlers:
             )
             return
 
-        encrypted_token = user_data['api_token_encrypted']
-        api_token = security.decrypt(encrypted_token)
-
-        if not api_token:
-            await update.message.reply_text(
-                "❌ Ошибка расшифровки токена.",
-                reply_markup=get_settings_keyboard()
-            )
-            return
-
-        loading_msg = await update.message.reply_text("⏳ Загружаем данные...")
+        loading_msg = await update.message.reply_text("⏳ Загружаем данные...", disable_notification=True)
 
         try:
-            api = MoyskladAPI(api_token)
+            api = _get_api(user.id, api_token)
             report = await api.get_sales_report(
                 period_data['date_from'],
                 period_data['date_to']
@@ -808,38 +1244,41 @@ class MenuHandlers:
                     reply_markup=get_report_keyboard()
                 )
 
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("Сбой API при получении кастомного отчета: %s", e)
+            await update.message.reply_text(
+                f"❌ Ошибка: {str(e)[:100]}",
+                reply_markup=get_report_keyboard()
+            )
+
         except Exception as e:
-            logger.error(f"Ошибка при получении кастомного отчета: {e}")
+            logger.exception("Ошибка при получении кастомного отчета")
             await update.message.reply_text(
                 f"❌ Ошибка: {str(e)[:100]}",
                 reply_markup=get_report_keyboard()
             )
 
         finally:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=loading_msg.message_id
-                )
-            except:
-                pass
+            # Удаление "Загружаем..." не должно задерживать ответ — в фон
+            _spawn(_safe_delete(
+                context.bot, update.effective_chat.id, loading_msg.message_id
+            ))
 
     @require_subscription(mode="full")
     async def show_detailed_reports_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню детализированных отчетов"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться и указать API-токен.",
+                _MSG_NEED_TOKEN,
                 reply_markup=get_main_menu()
             )
             return
 
         await update.message.reply_text(
-            "📊 *Детализированные отчеты*\n\n"
-            "Выберите тип отчета:",
+            _MSG_DETAILED_MENU,
             reply_markup=get_detailed_reports_keyboard(),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -848,22 +1287,21 @@ class MenuHandlers:
     async def handle_retail_sales_report_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Меню выбора периода для розничных продаж"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
+                _MSG_NEED_REGISTRATION,
                 reply_markup=get_main_menu(False)
             )
             return
 
         # ✅ Сохраняем тип отчета в контексте
         context.user_data['current_report_type'] = 'retail_sales'
-        logger.info(f"✅ Установлен тип отчета: retail_sales для пользователя {user.id}")
+        logger.info("✅ Установлен тип отчета: retail_sales для пользователя %s", user.id)
 
         await update.message.reply_text(
-            "🛍 *Розничные продажи*\n\n"
-            "Выберите период для отчета:",
+            _MSG_RETAIL_MENU,
             reply_markup=get_detailed_period_keyboard('retail_sales'),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -875,21 +1313,20 @@ class MenuHandlers:
     async def handle_demand_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Меню выбора периода для отгрузок"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
+                _MSG_NEED_REGISTRATION,
                 reply_markup=get_main_menu(False)
             )
             return
 
         context.user_data['current_report_type'] = 'demand'
-        logger.info(f"✅ Установлен тип отчета: demand для пользователя {user.id}")
+        logger.info("✅ Установлен тип отчета: demand для пользователя %s", user.id)
 
         await update.message.reply_text(
-            "🚚 *Отгрузки*\n\n"
-            "Выберите период для отчета:",
+            _MSG_DEMAND_MENU,
             reply_markup=get_detailed_period_keyboard('demand'),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -899,22 +1336,21 @@ class MenuHandlers:
     async def handle_customer_orders_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Меню выбора периода для заказов покупателей"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
+                _MSG_NEED_REGISTRATION,
                 reply_markup=get_main_menu(False)
             )
             return
 
         # ✅ Сохраняем тип отчета в контексте
         context.user_data['current_report_type'] = 'customer_orders'
-        logger.info(f"✅ Установлен тип отчета: customer_orders для пользователя {user.id}")
+        logger.info("✅ Установлен тип отчета: customer_orders для пользователя %s", user.id)
 
         await update.message.reply_text(
-            "📦 *Заказы покупателей*\n\n"
-            "Выберите период для отчета:",
+            _MSG_ORDERS_MENU,
             reply_markup=get_detailed_period_keyboard('customer_orders'),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -924,22 +1360,21 @@ class MenuHandlers:
     async def handle_combined_report_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Меню выбора периода для объединенного отчета"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
+                _MSG_NEED_REGISTRATION,
                 reply_markup=get_main_menu(False)
             )
             return
 
         # ✅ Сохраняем тип отчета в контексте
         context.user_data['current_report_type'] = 'combined_report'
-        logger.info(f"✅ Установлен тип отчета: combined_report для пользователя {user.id}")
+        logger.info("✅ Установлен тип отчета: combined_report для пользователя %s", user.id)
 
         await update.message.reply_text(
-            "📊 *Объединенный отчет*\n\n"
-            "Выберите период для отчета:",
+            _MSG_COMBINED_MENU,
             reply_markup=get_detailed_period_keyboard('combined_report'),
             parse_mode=ParseMode.MARKDOWN
         )
@@ -948,66 +1383,52 @@ class MenuHandlers:
     async def handle_top_products_month(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отчет по товарам: топ-20 за текущий месяц"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-
-        if not user_data or not user_data.get('api_token_encrypted'):
-            await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
-                reply_markup=get_main_menu(False)
-            )
-            return
-
-        encrypted_token = user_data['api_token_encrypted']
-        api_token = security.decrypt(encrypted_token)
-
+        user_data, api_token = await _require_api_token(
+            self.db, update, context, get_main_menu(False)
+        )
         if not api_token:
-            await update.message.reply_text(
-                "❌ Ошибка расшифровки токена. Обновите API-токен.",
-                reply_markup=get_settings_keyboard()
-            )
             return
 
         # Период – текущий месяц
         date_from, date_to = get_period_dates('month')
 
-        loading_msg = await update.message.reply_text("⏳ Формируем отчет по товарам за месяц...")
+        loading_msg = await update.message.reply_text("⏳ Формируем отчет по товарам за месяц...", disable_notification=True)
 
         try:
-            api = MoyskladAPI(api_token)
+            api = _get_api(user.id, api_token)
             top_items = await api.get_top_products(date_from, date_to, limit=20)
 
+            # Кнопка живет в меню аналитики, его клавиатура уже на экране —
+            # правим "Формируем..." на месте вместо пары отправка+удаление
             if not top_items:
-                await update.message.reply_text(
-                    "📭 Нет данных по продажам товаров за текущий месяц.",
-                    # После топа товаров остаемся в разделе аналитики
-                    reply_markup=get_analytics_keyboard()
+                await loading_msg.edit_text(
+                    "📭 Нет данных по продажам товаров за текущий месяц."
                 )
                 return
 
-            # Формируем текст отчета
-            from datetime import datetime
-            month_title = datetime.now().strftime('%m.%Y')
+            # Формируем текст отчета одним join, разбирая каждый товар
+            # за один проход вместо трех обращений к словарю в цикле.
+            # Заголовок месяца режем из уже вычисленного date_from
+            # (YYYY-MM-DD) — без datetime.now() и strftime
+            month_title = f"{date_from[5:7]}.{date_from[:4]}"
 
             lines = [
                 f"📊 *Топ-20 товаров за месяц ({month_title})*",
                 "",
             ]
-
-            for idx, item in enumerate(top_items, start=1):
-                lines.append(
-                    f"{idx}. *{item['name']}*\n"
-                    f"   Кол-во: {item['quantity']:.2f}\n"
-                    f"   Сумма: {item['amount']:,.2f} ₽\n"
+            lines.extend(
+                f"{idx}. *{name}*\n"
+                f"   Кол-во: {quantity:.2f}\n"
+                f"   Сумма: {amount:,.2f} ₽\n"
+                for idx, (name, quantity, amount) in enumerate(
+                    ((it['name'], it['quantity'], it['amount']) for it in top_items),
+                    start=1,
                 )
+            )
 
             text = "\n".join(lines)
 
-            await update.message.reply_text(
-                text,
-                parse_mode=ParseMode.MARKDOWN,
-                # После отчета по топ-20 возвращаем меню аналитики
-                reply_markup=get_analytics_keyboard()
-            )
+            await loading_msg.edit_text(text, parse_mode=ParseMode.MARKDOWN)
 
             # Логируем запрос
             self.db.log_request(
@@ -1016,22 +1437,17 @@ class MenuHandlers:
                 f"{date_from} - {date_to}"
             )
 
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("⚠️ Сбой API при формировании отчета по товарам: %s", e)
+            await loading_msg.edit_text(f"❌ Ошибка при формировании отчета: {str(e)[:120]}")
+
         except Exception as e:
-            logger.error(f"❌ Ошибка при формировании отчета по товарам: {e}", exc_info=True)
-            await update.message.reply_text(
-                f"❌ Ошибка при формировании отчета: {str(e)[:120]}",
-                # В случае ошибки тоже показываем аналитику, а не детальные отчеты
-                reply_markup=get_analytics_keyboard()
-            )
+            logger.exception("❌ Ошибка при формировании отчета по товарам")
+            await loading_msg.edit_text(f"❌ Ошибка при формировании отчета: {str(e)[:120]}")
 
-        finally:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=loading_msg.message_id
-                )
-            except Exception:
-                pass
+    def _is_in_detailed_report_flow(self, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Находится ли пользователь в потоке детальных отчетов."""
+        return not _DETAILED_FLOW_KEYS.isdisjoint(context.user_data)
 
     async def handle_detailed_custom_period(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Универсальный обработчик произвольного периода для детальных отчетов"""
@@ -1048,21 +1464,8 @@ class MenuHandlers:
 
         # Если это кнопка "🗓 Произвольный период"
         if user_input == "🗓 Произвольный период":
-            report_names = {
-                'retail_sales': 'розничных продаж',
-                'customer_orders': 'заказов покупателей',
-                'demand': 'отгрузок',
-                'combined_report': 'объединенного отчета'
-            }
-
-            report_name = report_names.get(report_type, 'отчета')
-
             await update.message.reply_text(
-                f"🗓 *Произвольный период для {report_name}*\n\n"
-                "Введите период в формате:\n"
-                "`ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`\n\n"
-                "Пример: `01.01.2026 - 31.01.2026`\n\n"
-                "Или введите одну дату для отчета за день: `01.01.2026`",
+                _CUSTOM_PERIOD_PROMPTS.get(report_type, _CUSTOM_PERIOD_PROMPT_DEFAULT),
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_back_keyboard()
             )
@@ -1074,23 +1477,7 @@ class MenuHandlers:
         # Если это ввод даты (ожидаем после нажатия кнопки)
         elif context.user_data.get('waiting_for_detailed_period'):
             try:
-                if ' - ' in user_input:
-                    # Диапазон дат
-                    date1_str, date2_str = user_input.split(' - ')
-                    date1 = datetime.strptime(date1_str.strip(), '%d.%m.%Y')
-                    date2 = datetime.strptime(date2_str.strip(), '%d.%m.%Y')
-
-                    if date1 > date2:
-                        date1, date2 = date2, date1
-
-                    date_from = date1.strftime('%Y-%m-%d')
-                    date_to = date2.strftime('%Y-%m-%d')
-                    period_name = f"{date1_str} - {date2_str}"
-                else:
-                    # Одна дата
-                    date = datetime.strptime(user_input.strip(), '%d.%m.%Y')
-                    date_from = date_to = date.strftime('%Y-%m-%d')
-                    period_name = user_input
+                date_from, date_to, period_name = _parse_period_input(user_input)
 
                 # Сохраняем период
                 context.user_data['detailed_custom_period'] = {
@@ -1103,16 +1490,14 @@ class MenuHandlers:
                 context.user_data.pop('waiting_for_detailed_period', None)
 
                 # ✅ ВАЖНО: Логируем какой отчет будет получен
-                logger.info(f"Получение отчета типа '{report_type}' за период {date_from} - {date_to}")
+                logger.info("Получение отчета типа '%s' за период %s - %s", report_type, date_from, date_to)
 
                 # Получаем отчет
                 await self._get_detailed_report_by_type(update, context, report_type, 'custom')
 
             except ValueError:
                 await update.message.reply_text(
-                    "❌ Неверный формат даты.\n"
-                    "Используйте формат: `ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`\n"
-                    "Пример: `01.01.2026 - 31.01.2026`",
+                    _ERR_BAD_DATE_EXAMPLE,
                     parse_mode=ParseMode.MARKDOWN
                 )
 
@@ -1129,37 +1514,21 @@ class MenuHandlers:
 
         if not report_type:
             # Если не ожидаем - это обычный ввод, показываем главное меню
-            logger.info(f"📅 Ввод дат без ожидания: '{user_input}'")
+            logger.info("📅 Ввод дат без ожидания: '%s'", user_input)
             user = update.effective_user
-            user_data = self.db.get_user(user.id)
-            is_registered = user_data and user_data.get('api_token_encrypted')
+            user_data = await _get_cached_user(self.db, user.id, context)
+            is_registered = user_data and user_data.get('has_token')
             await update.message.reply_text(
-                "📱 *Главное меню*\n\nВыберите нужный раздел:",
+                _MSG_MAIN_MENU,
                 reply_markup=get_main_menu(is_registered),
                 parse_mode=ParseMode.MARKDOWN
             )
             return
 
-        logger.info(f"📅 Обработка дат '{user_input}' для отчета типа '{report_type}'")
+        logger.info("📅 Обработка дат '%s' для отчета типа '%s'", user_input, report_type)
 
         try:
-            if ' - ' in user_input:
-                # Диапазон дат
-                date1_str, date2_str = user_input.split(' - ')
-                date1 = datetime.strptime(date1_str.strip(), '%d.%m.%Y')
-                date2 = datetime.strptime(date2_str.strip(), '%d.%m.%Y')
-
-                if date1 > date2:
-                    date1, date2 = date2, date1
-
-                date_from = date1.strftime('%Y-%m-%d')
-                date_to = date2.strftime('%Y-%m-%d')
-                period_name = f"{date1_str} - {date2_str}"
-            else:
-                # Одна дата
-                date = datetime.strptime(user_input.strip(), '%d.%m.%Y')
-                date_from = date_to = date.strftime('%Y-%m-%d')
-                period_name = user_input
+            date_from, date_to, period_name = _parse_period_input(user_input)
 
             # ✅ Сохраняем период
             context.user_data['detailed_custom_period'] = {
@@ -1168,7 +1537,7 @@ class MenuHandlers:
                 'period_name': period_name
             }
 
-            logger.info(f"📊 Получение отчета типа '{report_type}' за период {date_from} - {date_to}")
+            logger.info("📊 Получение отчета типа '%s' за период %s - %s", report_type, date_from, date_to)
 
             # ✅ Очищаем флаг ожидания
             context.user_data.pop('expecting_custom_period_for', None)
@@ -1178,9 +1547,7 @@ class MenuHandlers:
 
         except ValueError:
             await update.message.reply_text(
-                "❌ Неверный формат даты.\n"
-                "Используйте формат: `ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`\n\n"
-                "Попробуйте снова:",
+                _ERR_BAD_DATE_RETRY,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_back_keyboard()
             )
@@ -1193,17 +1560,9 @@ class MenuHandlers:
 
         # ✅ Берем тип отчета из контекста
         report_type = context.user_data.get('current_report_type', 'customer_orders')
-        logger.info(f"📝 Выбор периода '{user_input}' для отчета типа '{report_type}'")
-
-        # Маппинг текста кнопок на типы периодов
-        period_mapping = {
-            '📅 Сегодня': 'today',
-            '📆 Неделя': 'week',
-            '📈 Месяц': 'month',
-            '🗓 Произвольный период': 'custom'
-        }
+        logger.info("📝 Выбор периода '%s' для отчета типа '%s'", user_input, report_type)
 
-        period_type = period_mapping.get(user_input)
+        period_type = _PERIOD_MAPPING.get(user_input)
 
         if not period_type:
             await update.message.reply_text(
@@ -1222,30 +1581,17 @@ class MenuHandlers:
 
     async def _ask_custom_period_for_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE, report_type: str):
         """Запрос произвольного периода для указанного типа отчета"""
-        report_names = {
-            'retail_sales': 'розничных продаж',
-            'customer_orders': 'заказов покупателей',
-            'demand': 'отгрузок',
-            'combined_report': 'объединенного отчета'
-        }
-
-        report_name = report_names.get(report_type, 'отчета')
-
-        logger.info(f"🗓 Запрос произвольного периода для отчета '{report_type}'")
+        logger.info("🗓 Запрос произвольного периода для отчета '%s'", report_type)
 
         await update.message.reply_text(
-            f"🗓 *Произвольный период для {report_name}*\n\n"
-            "Введите период в формате:\n"
-            "`ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`\n\n"
-            "Пример: `01.01.2026 - 31.01.2026`\n\n"
-            "Или введите одну дату для отчета за день: `01.01.2026`",
+            _CUSTOM_PERIOD_PROMPTS.get(report_type, _CUSTOM_PERIOD_PROMPT_DEFAULT),
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=get_back_keyboard()
         )
 
         # ✅ Сохраняем тип отчета для обработки ввода дат
         context.user_data['expecting_custom_period_for'] = report_type
-        logger.info(f"💾 Ожидаем ввод дат для отчета типа '{report_type}'")
+        logger.info("💾 Ожидаем ввод дат для отчета типа '%s'", report_type)
 
     async def process_detailed_custom_period(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка произвольного периода для детальных отчетов"""
@@ -1258,26 +1604,10 @@ class MenuHandlers:
                 context.user_data.get('detailed_report_type', 'customer_orders')
         )
 
-        logger.info(f"📅 Обработка дат для отчета типа '{report_type}': '{user_input}'")
+        logger.info("📅 Обработка дат для отчета типа '%s': '%s'", report_type, user_input)
 
         try:
-            if ' - ' in user_input:
-                # Диапазон дат
-                date1_str, date2_str = user_input.split(' - ')
-                date1 = datetime.strptime(date1_str.strip(), '%d.%m.%Y')
-                date2 = datetime.strptime(date2_str.strip(), '%d.%m.%Y')
-
-                if date1 > date2:
-                    date1, date2 = date2, date1
-
-                date_from = date1.strftime('%Y-%m-%d')
-                date_to = date2.strftime('%Y-%m-%d')
-                period_name = f"{date1_str} - {date2_str}"
-            else:
-                # Одна дата
-                date = datetime.strptime(user_input.strip(), '%d.%m.%Y')
-                date_from = date_to = date.strftime('%Y-%m-%d')
-                period_name = user_input
+            date_from, date_to, period_name = _parse_period_input(user_input)
 
             # ✅ ВАЖНО: Сохраняем период с правильным ключом
             context.user_data['detailed_custom_period'] = {
@@ -1286,7 +1616,7 @@ class MenuHandlers:
                 'period_name': period_name
             }
 
-            logger.info(f"📊 Получение отчета типа '{report_type}' за период {date_from} - {date_to}")
+            logger.info("📊 Получение отчета типа '%s' за период %s - %s", report_type, date_from, date_to)
 
             # Получаем отчет
             await self._get_detailed_report_by_type(update, context, report_type, 'custom')
@@ -1299,8 +1629,7 @@ class MenuHandlers:
 
         except ValueError:
             await update.message.reply_text(
-                "❌ Неверный формат даты.\n"
-                "Используйте формат: `ДД.ММ.ГГГГ - ДД.ММ.ГГГГ`",
+                _ERR_BAD_DATE,
                 parse_mode=ParseMode.MARKDOWN
             )
             return 'WAITING_DETAILED_CUSTOM_PERIOD'
@@ -1309,23 +1638,10 @@ class MenuHandlers:
                                            report_type: str, period_type: str):
         """Получение детального отчета по типу"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-
-        if not user_data or not user_data.get('api_token_encrypted'):
-            await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
-                reply_markup=get_main_menu(False)
-            )
-            return
-
-        encrypted_token = user_data['api_token_encrypted']
-        api_token = security.decrypt(encrypted_token)
-
+        user_data, api_token = await _require_api_token(
+            self.db, update, context, get_main_menu(False)
+        )
         if not api_token:
-            await update.message.reply_text(
-                "❌ Ошибка расшифровки токена.",
-                reply_markup=get_settings_keyboard()
-            )
             return
 
         # Определяем даты периода
@@ -1333,7 +1649,7 @@ class MenuHandlers:
             period_data = context.user_data.get('detailed_custom_period', {})
 
             if not period_data:
-                logger.error(f"❌ Нет данных периода для отчета типа '{report_type}'")
+                logger.error("❌ Нет данных периода для отчета типа '%s'", report_type)
                 await update.message.reply_text(
                     "❌ Ошибка: период не указан.",
                     reply_markup=get_detailed_period_keyboard(report_type)
@@ -1350,75 +1666,53 @@ class MenuHandlers:
             date_from, date_to = get_period_dates(period_type)
             period_display = period_type
 
-        logger.info(f"📊 ЗАПРОС: report_type='{report_type}', period='{date_from} - {date_to}'")
+        logger.info("📊 ЗАПРОС: report_type='%s', period='%s - %s'", report_type, date_from, date_to)
 
-        loading_msg = await update.message.reply_text("⏳ Загружаем данные...")
+        loading_msg = await update.message.reply_text("⏳ Загружаем данные...", disable_notification=True)
 
         try:
-            api = MoyskladAPI(api_token)
-
-            if report_type == 'retail_sales':
-                # ✅ ВАЖНО: Используем правильный метод для розничных продаж
-                logger.info(f"🛍 Вызов get_retail_sales_report()")
-                report = await api.get_retail_sales_report(date_from, date_to)
+            api = _get_api(user.id, api_token)
 
-                if report:
-                    report.period = period_display
-                    report_text = report.format_retail_report()
-                    logger.info(
-                        f"✅ Получен отчет по розничным продажам: {report.total_orders} чеков, {report.total_sales:.2f} руб")
-                else:
-                    report_text = f"📭 Нет розничных продаж за период: {period_display}"
-                    logger.info(f"📭 Нет данных по розничным продажам")
-
-            elif report_type == 'customer_orders':
-                logger.info(f"📦 Вызов get_sales_report()")
-                report = await api.get_sales_report(date_from, date_to)
-
-                if report:
-                    report.period = period_display
-                    report_text = report.format_report()
-                    logger.info(
-                        f"✅ Получен отчет по заказам: {report.total_orders} заказов, {report.total_sales:.2f} руб")
-                else:
-                    report_text = f"📭 Нет заказов покупателей за период: {period_display}"
-                    logger.info(f"📭 Нет данных по заказам")
-
-            elif report_type == 'demand':
-                logger.info(f"🚚 Вызов get_demand_report()")
-                report = await api.get_demand_report(date_from, date_to)
-
-                if report:
-                    report.period = period_display
-                    report_text = report.format_demand_report()
-                    logger.info(
-                        f"✅ Получен отчет по отгрузкам: {report.total_orders} отгрузок, {report.total_sales:.2f} руб")
-                else:
-                    report_text = f"📭 Нет отгрузок за период: {period_display}"
-                    logger.info(f"📭 Нет данных по отгрузкам")
-
-            elif report_type == 'combined_report':
-                logger.info(f"📊 Вызов get_combined_sales_report()")
-                report = await api.get_combined_sales_report(date_from, date_to)
+            dispatch = _REPORT_DISPATCH.get(report_type)
+            if dispatch is None:
+                report_text = "❌ Неизвестный тип отчета"
+                logger.error("❌ Неизвестный тип отчета: %s", report_type)
+            else:
+                api_method, formatter, empty_template = dispatch
+                logger.info("Вызов %s()", api_method)
+                report = await getattr(api, api_method)(date_from, date_to)
 
                 if report:
                     report.period = period_display
-                    report_text = report.format_combined_report()
-                    logger.info(f"✅ Получен объединенный отчет")
+                    report_text = getattr(report, formatter)()
+                    if report_type == 'combined_report':
+                        # Диаграмма распределения едет в том же сообщении —
+                        # без второго запроса к Bot API
+                        report_text += (
+                            "\n📊 *Распределение продаж:*\n\n"
+                            + self._generate_sales_diagram(report.retail_share, report.orders_share)
+                        )
+                    logger.info("✅ Отчет '%s' получен", report_type)
                 else:
-                    report_text = f"📭 Нет данных для объединенного отчета за период: {period_display}"
-                    logger.info(f"📭 Нет данных для объединенного отчета")
-
+                    report_text = empty_template.format(period_display)
+                    logger.info("📭 Нет данных для отчета '%s'", report_type)
+
+            # Отправляем отчет. После выбора готового периода клавиатура
+            # периодов уже на экране — правим "Загружаем..." на месте: один
+            # запрос к Bot API вместо пары отправка+удаление. После ручного
+            # ввода дат на экране клавиатура "Назад", а reply-клавиатуру через
+            # edit не передать — там остается старая пара сообщений.
+            if period_type == 'custom':
+                await update.message.reply_text(
+                    report_text,
+                    parse_mode=ParseMode.MARKDOWN,
+                    reply_markup=get_detailed_period_keyboard(report_type)
+                )
+                _spawn(_safe_delete(
+                    context.bot, update.effective_chat.id, loading_msg.message_id
+                ))
             else:
-                report_text = "❌ Неизвестный тип отчета"
-                logger.error(f"❌ Неизвестный тип отчета: {report_type}")
-
-            # Отправляем отчет
-            await update.message.reply_text(
-                report_text,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=get_detailed_period_keyboard(report_type)
-            )
+                await loading_msg.edit_text(report_text, parse_mode=ParseMode.MARKDOWN)
 
             # Логируем запрос
             self.db.log_request(
@@ -1428,20 +1722,14 @@ class MenuHandlers:
             )
 
         except Exception as e:
-            logger.error(f"❌ Ошибка при получении отчета {report_type}: {e}", exc_info=True)
+            logger.error("❌ Ошибка при получении отчета %s: %s", report_type, e, exc_info=True)
             await update.message.reply_text(
                 f"❌ Ошибка при получении отчета: {str(e)[:100]}",
                 reply_markup=get_detailed_period_keyboard(report_type)
             )
-
-        finally:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=loading_msg.message_id
-                )
-            except:
-                pass
+            _spawn(_safe_delete(
+                context.bot, update.effective_chat.id, loading_msg.message_id
+            ))
 
     async def back_to_detailed_reports(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Возврат к меню детальных отчетов"""
@@ -1450,53 +1738,51 @@ class MenuHandlers:
 
     def _generate_sales_diagram(self, retail_share: float, orders_share: float) -> str:
         """Генерация текстовой диаграммы распределения продаж"""
-        bar_length = 20
-        retail_bars = int((retail_share / 100) * bar_length)
-        orders_bars = bar_length - retail_bars
-
-        diagram = (
-            f"🛍 Розничные: {'█' * retail_bars}{'░' * orders_bars} {retail_share:.1f}%\n"
-            f"📦 Заказы:    {'░' * retail_bars}{'█' * orders_bars} {orders_share:.1f}%\n"
-            f"              {'1' + ' ' * (bar_length - 2) + str(bar_length)}"
-        )
+        retail_bars = min(max(int((retail_share / 100) * _BAR_LENGTH), 0), _BAR_LENGTH)
+        orders_bars = _BAR_LENGTH - retail_bars
 
-        return diagram
+        return (
+            f"🛍 Розничные: {_BAR_FULL[retail_bars]}{_BAR_EMPTY[orders_bars]} {retail_share:.1f}%\n"
+            f"📦 Заказы:    {_BAR_EMPTY[retail_bars]}{_BAR_FULL[orders_bars]} {orders_share:.1f}%\n"
+            f"              {_BAR_AXIS}"
+        )
 
     # добавляем метод для быстрого отчета
     async def handle_quick_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик быстрого отчета"""
         user = update.effective_user
-        logger.info(f"📊 Запрос быстрого отчета от пользователя {user.id}")
+        logger.info("📊 Запрос быстрого отчета от пользователя %s", user.id)
 
         # Проверяем регистрацию
-        user_data = self.db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = user_data and user_data.get('has_token')
 
         if not is_registered:
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.\n"
-                "Используйте /start для регистрации.",
+                _MSG_NEED_REGISTRATION_START,
                 reply_markup=get_main_menu(False)  # ✅ ПРАВИЛЬНО
             )
             return
 
         # Показываем сообщение о загрузке
-        loading_msg = await update.message.reply_text("⏳ Формируем быстрый отчет...")
+        loading_msg = await update.message.reply_text("⏳ Формируем быстрый отчет...", disable_notification=True)
 
         try:
             # Получаем и расшифровываем токен
-            encrypted_token = user_data['api_token_encrypted']
-            api_token = security.decrypt(encrypted_token)
+            api_token = await _get_api_token(self.db, user.id)
 
             if not api_token:
                 await update.message.reply_text(
                     "❌ Ошибка расшифровки токена. Обновите API-токен в настройках.",
                     reply_markup=get_settings_keyboard()
                 )
+                _spawn(_safe_delete(
+                    context.bot, update.effective_chat.id, loading_msg.message_id
+                ))
                 return
 
             # Создаем API клиент и получаем отчет
-            api = MoyskladAPI(api_token)
+            api = _get_api(user.id, api_token)
             quick_report = await api.get_quick_report()
 
             if quick_report:
@@ -1513,15 +1799,17 @@ class MenuHandlers:
                             "*\"💳 Подписка\"* в главном меню."
                         )
 
-                await update.message.reply_text(
+                # Кнопка нажата из главного меню — его клавиатура уже на
+                # экране, поэтому просто правим "Формируем..." на месте:
+                # один запрос к Bot API вместо пары отправка+удаление
+                await loading_msg.edit_text(
                     report_text + extra_note,
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=get_main_menu(True)
+                    parse_mode=ParseMode.MARKDOWN
                 )
 
                 # Логируем успешный запрос
                 self.db.log_request(user_data['id'], 'quick_report', 'today+week+month')
-                logger.info(f"✅ Быстрый отчет отправлен пользователю {user.id}")
+                logger.info("✅ Быстрый отчет отправлен пользователю %s", user.id)
 
             else:
                 await update.message.reply_text(
@@ -1532,30 +1820,28 @@ class MenuHandlers:
                     "• Ошибка в настройках токена",
                     reply_markup=get_main_menu(False)
                 )
+                _spawn(_safe_delete(
+                    context.bot, update.effective_chat.id, loading_msg.message_id
+                ))
 
         except Exception as e:
-            logger.error(f"❌ Ошибка при получении быстрого отчета: {e}", exc_info=True)
+            logger.error("❌ Ошибка при получении быстрого отчета: %s", e, exc_info=True)
             await update.message.reply_text(
                 f"❌ Произошла ошибка при формировании отчета:\n\n"
                 f"```{str(e)[:150]}```",
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_main_menu(False)
             )
-
-        finally:
-            # Удаляем сообщение о загрузке
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=loading_msg.message_id
-                )
-            except:
-                pass
+            _spawn(_safe_delete(
+                context.bot, update.effective_chat.id, loading_msg.message_id
+            ))
 
 
 class NotificationHandlers:
     """Обработчики управления уведомлениями"""
 
+    __slots__ = ('db',)
+
     def __init__(self, db: Database):
         self.db = db
 
@@ -1571,12 +1857,11 @@ class NotificationHandlers:
     async def notifications_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать статус уведомлений и кнопки управления"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться и указать API-токен.\n"
-                "Используйте /start для регистрации.",
+                _MSG_NEED_TOKEN_START,
                 reply_markup=get_main_menu(False)
             )
             return
@@ -1590,35 +1875,18 @@ class NotificationHandlers:
             "monthly": "09:01",
         }
 
-        # Формируем текст сообщения
-        status_emoji = "✅" if is_enabled else "❌"
-        status_text = "включены" if is_enabled else "выключены"
-        
+        # Формируем текст сообщения: переменная часть — статус и времена,
+        # хвост берем готовым из модульных констант
+        status_line = "включены ✅" if is_enabled else "выключены ❌"
+
         message_text = (
             f"🔔 *Управление уведомлениями*\n\n"
-            f"Статус: Уведомления {status_text} {status_emoji}\n\n"
+            f"Статус: Уведомления {status_line}\n\n"
             f"*Текущее время отправки (МСК):*\n"
             f"• Ежедневный отчет: `{times['daily']}`\n"
             f"• Недельный отчет: `{times['weekly']}`\n"
             f"• Месячный отчет: `{times['monthly']}`\n\n"
-        )
-        
-        if is_enabled:
-            message_text += (
-                "*Вы получаете автоматические отчеты:*\n"
-                "• Ежедневно - статистика за вчера\n"
-                "• По понедельникам - статистика за неделю\n"
-                "• 1 числа месяца - отчет за прошлый месяц\n\n"
-                "Используйте кнопки ниже для управления временем."
-            )
-        else:
-            message_text += (
-                "*При включении вы будете получать:*\n"
-                "• Ежедневно - статистика за вчера\n"
-                "• По понедельникам - статистика за неделю\n"
-                "• 1 числа месяца - отчет за прошлый месяц\n\n"
-                "Можно заранее настроить время для каждого типа отчета."
-            )
+        ) + (_NOTIF_TAIL_ENABLED if is_enabled else _NOTIF_TAIL_DISABLED)
 
         await update.message.reply_text(
             message_text,
@@ -1632,10 +1900,10 @@ class NotificationHandlers:
         button_text = update.message.text
 
         # Проверяем регистрацию
-        user_data = self.db.get_user(user.id)
-        if not user_data or not user_data.get('api_token_encrypted'):
+        user_data = await _get_cached_user(self.db, user.id, context)
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
+                _MSG_NEED_REGISTRATION,
                 reply_markup=get_main_menu(False)
             )
             return
@@ -1643,10 +1911,11 @@ class NotificationHandlers:
         # Определяем действие по тексту кнопки
         if button_text == "🔔 Включить уведомления":
             # Включаем уведомления
-            success = self.db.update_notification_setting(user.id, True)
+            success = await _run(self.db.update_notification_setting, user.id, True)
             
             if success:
-                logger.info(f"✅ Уведомления включены для пользователя {user.id}")
+                _invalidate_user_cache(context)
+                logger.info("✅ Уведомления включены для пользователя %s", user.id)
                 await update.message.reply_text(
                     "✅ *Уведомления включены!*\n\n"
                     "Вы будете получать автоматические отчеты:\n"
@@ -1665,10 +1934,11 @@ class NotificationHandlers:
 
         elif button_text == "🔕 Выключить уведомления":
             # Выключаем уведомления
-            success = self.db.update_notification_setting(user.id, False)
+            success = await _run(self.db.update_notification_setting, user.id, False)
             
             if success:
-                logger.info(f"🔕 Уведомления выключены для пользователя {user.id}")
+                _invalidate_user_cache(context)
+                logger.info("🔕 Уведомления выключены для пользователя %s", user.id)
                 await update.message.reply_text(
                     "🔕 *Уведомления выключены*\n\n"
                     "Вы больше не будете получать автоматические отчеты.\n"
@@ -1684,9 +1954,9 @@ class NotificationHandlers:
 
         elif button_text == "◀️ Назад в меню":
             # Возврат в главное меню
-            is_registered = user_data and user_data.get('api_token_encrypted')
+            is_registered = user_data and user_data.get('has_token')
             await update.message.reply_text(
-                "📱 *Главное меню*\n\nВыберите нужный раздел:",
+                _MSG_MAIN_MENU,
                 reply_markup=get_main_menu(is_registered),
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1723,7 +1993,7 @@ class NotificationHandlers:
             )
             return
 
-        success = self.db.update_notification_time(user.id, waiting_period, normalized)
+        success = await _run(self.db.update_notification_time, user.id, waiting_period, normalized)
         if not success:
             await update.message.reply_text(
                 "❌ Не удалось сохранить время уведомления. Попробуйте позже.",
@@ -1750,6 +2020,8 @@ class NotificationHandlers:
 class PaymentHandlers:
     """Обработчики платежей через Telegram (Invoice + ЮKassa)"""
 
+    __slots__ = ('db',)
+
     def __init__(self, db: Database):
         self.db = db
 
@@ -1759,7 +2031,7 @@ class PaymentHandlers:
         await query.answer()
 
         user = update.effective_user
-        logger.info(f"💳 Запрос на создание счета от пользователя {user.id}")
+        logger.info("💳 Запрос на создание счета от пользователя %s", user.id)
 
         if not config.TELEGRAM_PROVIDER_TOKEN:
             logger.warning("❌ TELEGRAM_PROVIDER_TOKEN не настроен")
@@ -1768,16 +2040,16 @@ class PaymentHandlers:
             )
             return
 
-        user_data = self.db.get_user(user.id)
-        if not user_data or not user_data.get('api_token_encrypted'):
-            logger.warning(f"❌ Пользователь {user.id} не зарегистрирован")
+        user_data = await _get_cached_user(self.db, user.id, context)
+        if not user_data or not user_data.get('has_token'):
+            logger.warning("❌ Пользователь %s не зарегистрирован", user.id)
             await query.message.reply_text(
                 "❌ Сначала необходимо зарегистрироваться через /start."
             )
             return
 
         if is_superadmin(user.id):
-            logger.info(f"👑 Пользователь {user.id} является суперадмином")
+            logger.info("👑 Пользователь %s является суперадмином", user.id)
             await query.message.reply_text(
                 "👑 Вы суперадмин — подписка для вас всегда активна, оплата не требуется."
             )
@@ -1786,8 +2058,8 @@ class PaymentHandlers:
         amount_kopecks = config.SUBSCRIPTION_PRICE_RUB * 100
         prices = [LabeledPrice(label="Подписка на 1 месяц", amount=amount_kopecks)]
 
-        logger.info(f"💰 Создание счета: {config.SUBSCRIPTION_PRICE_RUB} ₽ ({amount_kopecks} копеек)")
-        logger.info(f"🔑 Токен провайдера: {config.TELEGRAM_PROVIDER_TOKEN[:20]}...")
+        logger.info("💰 Создание счета: %s ₽ (%s копеек)", config.SUBSCRIPTION_PRICE_RUB, amount_kopecks)
+        logger.info("🔑 Токен провайдера: %s...", config.TELEGRAM_PROVIDER_TOKEN[:20])
 
         try:
             invoice = await context.bot.send_invoice(
@@ -1806,9 +2078,9 @@ class PaymentHandlers:
                 start_parameter="subscription",
                 send_email_to_provider=True,
             )
-            logger.info(f"✅ Счёт успешно отправлен пользователю {user.id}, message_id={invoice.message_id}")
+            logger.info("✅ Счёт успешно отправлен пользователю %s, message_id=%s", user.id, invoice.message_id)
         except Exception as e:
-            logger.error(f"❌ Ошибка отправки счёта пользователю {user.id}: {e}", exc_info=True)
+            logger.error("❌ Ошибка отправки счёта пользователю %s: %s", user.id, e, exc_info=True)
             await query.message.reply_text(
                 f"❌ Не удалось создать платёж.\n\n"
                 f"Ошибка: {str(e)}\n\n"
@@ -1833,14 +2105,14 @@ class PaymentHandlers:
 
         payload = payment.invoice_payload or ""
         if not payload.startswith("subscription_"):
-            logger.warning(f"Неожиданный payload платежа: {payload}")
+            logger.warning("Неожиданный payload платежа: %s", payload)
             return
 
         telegram_id = user.id
 
-        user_data = self.db.get_user(telegram_id)
+        user_data = await _get_cached_user(self.db, telegram_id, context)
         if not user_data:
-            logger.warning(f"Оплата от неизвестного пользователя {telegram_id}")
+            logger.warning("Оплата от неизвестного пользователя %s", telegram_id)
             await update.message.reply_text("❌ Пользователь не найден в базе. Обратитесь к администратору.")
             return
 
@@ -1867,8 +2139,9 @@ class PaymentHandlers:
             status="active",
             expires_at=new_expires,
         )
+        _invalidate_user_cache(context)
 
-        logger.info(f"Подписка продлена для пользователя {telegram_id} до {new_expires}")
+        logger.info("Подписка продлена для пользователя %s до %s", telegram_id, new_expires)
 
         await update.message.reply_text(
             "✅ *Оплата получена!*\n\n"
@@ -1882,6 +2155,8 @@ class PaymentHandlers:
 class ReminderHandlers:
     """Обработчики напоминалок — выгрузка клиентов по отгрузкам за прошлые годы"""
 
+    __slots__ = ('db',)
+
     def __init__(self, db: Database):
         self.db = db
 
@@ -1889,11 +2164,11 @@ class ReminderHandlers:
     async def ask_reminder_date(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Запрос даты для формирования напоминалок"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get('api_token_encrypted'):
+        if not user_data or not user_data.get('has_token'):
             await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться и указать API-токен.",
+                _MSG_NEED_TOKEN,
                 reply_markup=get_main_menu(False)
             )
             return ConversationHandler.END
@@ -1918,10 +2193,10 @@ class ReminderHandlers:
         user_input = update.message.text.strip()
 
         if user_input == "🔙 Назад":
-            user_data = self.db.get_user(user.id)
-            is_registered = user_data and user_data.get('api_token_encrypted')
+            user_data = await _get_cached_user(self.db, user.id, context)
+            is_registered = user_data and user_data.get('has_token')
             await update.message.reply_text(
-                "📱 *Главное меню*\n\nВыберите нужный раздел:",
+                _MSG_MAIN_MENU,
                 reply_markup=get_main_menu(is_registered),
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1938,32 +2213,21 @@ class ReminderHandlers:
             )
             return WAITING_REMINDER_DATE
 
-        user_data = self.db.get_user(user.id)
-        if not user_data or not user_data.get('api_token_encrypted'):
-            await update.message.reply_text(
-                "❌ Сначала необходимо зарегистрироваться.",
-                reply_markup=get_main_menu(False)
-            )
-            return ConversationHandler.END
-
-        encrypted_token = user_data['api_token_encrypted']
-        api_token = security.decrypt(encrypted_token)
-
+        user_data, api_token = await _require_api_token(
+            self.db, update, context, get_main_menu(False)
+        )
         if not api_token:
-            await update.message.reply_text(
-                "❌ Ошибка расшифровки токена. Обновите API-токен.",
-                reply_markup=get_settings_keyboard()
-            )
             return ConversationHandler.END
 
         end_date = base_date + timedelta(days=10)
         loading_msg = await update.message.reply_text(
             f"⏳ Ищем отгрузки за окно {base_date.strftime('%d.%m')} — "
-            f"{end_date.strftime('%d.%m')} за последние 5 лет..."
+            f"{end_date.strftime('%d.%m')} за последние 5 лет...",
+            disable_notification=True
         )
 
         try:
-            api = MoyskladAPI(api_token)
+            api = _get_api(user.id, api_token)
             reminders = await api.get_reminders_data(
                 base_date.strftime('%Y-%m-%d'),
                 days_window=10,
@@ -2073,28 +2337,25 @@ class ReminderHandlers:
             )
 
         except Exception as e:
-            logger.error(f"❌ Ошибка при формировании напоминалок: {e}", exc_info=True)
+            logger.error("❌ Ошибка при формировании напоминалок: %s", e, exc_info=True)
             await update.message.reply_text(
                 f"❌ Ошибка при формировании напоминалок: {str(e)[:150]}",
                 reply_markup=get_main_menu(True)
             )
 
         finally:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=loading_msg.message_id
-                )
-            except Exception:
-                pass
+            # Удаление "Загружаем..." не должно задерживать ответ — в фон
+            _spawn(_safe_delete(
+                context.bot, update.effective_chat.id, loading_msg.message_id
+            ))
 
         return ConversationHandler.END
 
     async def cancel_reminder(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отмена формирования напоминалок"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = user_data and user_data.get('has_token')
 
         await update.message.reply_text(
             "❌ Формирование напоминалок отменено.",
@@ -2113,6 +2374,8 @@ GIGACHAT_DIALOG = "GIGACHAT_DIALOG"
 class GigaChatHandlers:
     """Обработчики диалога с GigaChat ИИ-ассистентом."""
 
+    __slots__ = ('db',)
+
     def __init__(self, db: Database):
         self.db = db
 
@@ -2121,9 +2384,9 @@ class GigaChatHandlers:
         from gigachat_handler import gigachat_assistant
 
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        user_data = await _get_cached_user(self.db, user.id, context)
 
-        if not user_data or not user_data.get("api_token_encrypted"):
+        if not user_data or not user_data.get("has_token"):
             await update.message.reply_text(
                 "❌ Для использования ИИ-ассистента сначала зарегистрируйтесь и добавьте API-токен МойСклад.",
                 reply_markup=get_main_menu(False),
@@ -2181,8 +2444,8 @@ class GigaChatHandlers:
             )
             return GIGACHAT_DIALOG
 
-        user_data = self.db.get_user(user.id)
-        if not user_data or not user_data.get("api_token_encrypted"):
+        user_data = await _get_cached_user(self.db, user.id, context)
+        if not user_data or not user_data.get("has_token"):
             await update.message.reply_text(
                 "❌ Не найден API-токен МойСклад.",
                 reply_markup=get_main_menu(False),
@@ -2190,7 +2453,7 @@ class GigaChatHandlers:
             return ConversationHandler.END
 
         try:
-            api_token = security.decrypt(user_data["api_token_encrypted"])
+            api_token = await _get_api_token(self.db, user.id)
         except Exception:
             await update.message.reply_text(
                 "❌ Ошибка расшифровки API-токена. Попробуйте обновить токен в настройках.",
@@ -2198,7 +2461,7 @@ class GigaChatHandlers:
             )
             return ConversationHandler.END
 
-        loading_msg = await update.message.reply_text("⏳ Думаю...")
+        loading_msg = await update.message.reply_text("⏳ Думаю...", disable_notification=True)
 
         try:
             history = context.user_data.get("ai_history", [])
@@ -2209,10 +2472,9 @@ class GigaChatHandlers:
             )
             context.user_data["ai_history"] = new_history
 
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=loading_msg.message_id,
-            )
+            _spawn(_safe_delete(
+                context.bot, update.effective_chat.id, loading_msg.message_id
+            ))
 
             await update.message.reply_text(
                 answer,
@@ -2221,14 +2483,10 @@ class GigaChatHandlers:
             )
 
         except Exception as e:
-            logger.error(f"Ошибка GigaChat для пользователя {user.id}: {e}", exc_info=True)
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=loading_msg.message_id,
-                )
-            except Exception:
-                pass
+            logger.error("Ошибка GigaChat для пользователя %s: %s", user.id, e, exc_info=True)
+            _spawn(_safe_delete(
+                context.bot, update.effective_chat.id, loading_msg.message_id
+            ))
             await update.message.reply_text(
                 "❌ Не удалось получить ответ от ИИ. Попробуйте позже.",
                 reply_markup=get_ai_chat_keyboard(),
@@ -2240,8 +2498,8 @@ class GigaChatHandlers:
         """Выход из режима диалога с ИИ."""
         context.user_data.pop("ai_history", None)
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        is_registered = bool(user_data and user_data.get("api_token_encrypted"))
+        user_data = await _get_cached_user(self.db, user.id, context)
+        is_registered = bool(user_data and user_data.get("has_token"))
 
         await update.message.reply_text(
             "👋 Вышли из режима ИИ-ассистента.",
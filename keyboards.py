@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from telegram import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -5,10 +7,14 @@ from telegram import (
     InlineKeyboardButton
 )
 
+# Клавиатуры в PTB v20 неизменяемые, поэтому каждую раскладку можно собрать
+# один раз и переиспользовать, вместо создания новых KeyboardButton на
+# каждый ответ. Публичные функции нормализуют аргументы (is_registered
+# часто приходит строкой токена или None) и отдают закешированный объект.
 
 
-def get_main_menu(is_registered: bool = False):
-    """Главное меню бота"""
+@lru_cache(maxsize=None)
+def _build_main_menu(is_registered: bool) -> ReplyKeyboardMarkup:
     if is_registered:
         keyboard = [
             [KeyboardButton("📊 Быстрый отчет"), KeyboardButton("📊 Детальные отчеты")],
@@ -25,6 +31,12 @@ def get_main_menu(is_registered: bool = False):
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
+def get_main_menu(is_registered: bool = False):
+    """Главное меню бота"""
+    return _build_main_menu(bool(is_registered))
+
+
+@lru_cache(maxsize=None)
 def get_phone_keyboard():
     """Клавиатура для запроса номера телефона"""
     keyboard = [
@@ -34,6 +46,7 @@ def get_phone_keyboard():
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
 
 
+@lru_cache(maxsize=None)
 def get_report_keyboard():
     """Клавиатура для выбора отчетов"""
     keyboard = [
@@ -44,6 +57,7 @@ def get_report_keyboard():
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
+@lru_cache(maxsize=None)
 def get_settings_keyboard():
     """Клавиатура настроек"""
     keyboard = [
@@ -55,12 +69,14 @@ def get_settings_keyboard():
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
+@lru_cache(maxsize=None)
 def get_back_keyboard():
     """Простая кнопка назад"""
     keyboard = [[KeyboardButton("🔙 Назад")]]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
+@lru_cache(maxsize=None)
 def get_analytics_keyboard():
     """Клавиатура для аналитики"""
     keyboard = [
@@ -71,7 +87,9 @@ def get_analytics_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+
 # Обновим функцию детализированных отчетов
+@lru_cache(maxsize=None)
 def get_detailed_reports_keyboard():
     """Клавиатура детализированных отчетов"""
     keyboard = [
@@ -84,9 +102,8 @@ def get_detailed_reports_keyboard():
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
-
-def get_detailed_period_keyboard(report_type: str = None):
-    """Клавиатура выбора периода для детальных отчетов"""
+@lru_cache(maxsize=None)
+def _build_detailed_period_keyboard() -> ReplyKeyboardMarkup:
     keyboard = [
         [KeyboardButton("📅 Сегодня"), KeyboardButton("📆 Неделя")],
         [KeyboardButton("📈 Месяц"), KeyboardButton("🗓 Произвольный период")],
@@ -95,6 +112,13 @@ def get_detailed_period_keyboard(report_type: str = None):
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
+def get_detailed_period_keyboard(report_type: str = None):
+    """Клавиатура выбора периода для детальных отчетов"""
+    # Раскладка не зависит от типа отчета — всегда один и тот же объект
+    return _build_detailed_period_keyboard()
+
+
+@lru_cache(maxsize=None)
 def get_subscription_payment_keyboard() -> InlineKeyboardMarkup:
     """Инлайн-кнопка для оплаты подписки через Telegram (Invoice)"""
     keyboard = [
@@ -103,6 +127,7 @@ def get_subscription_payment_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=None)
 def get_ai_chat_keyboard() -> ReplyKeyboardMarkup:
     """Клавиатура для режима диалога с ИИ"""
     keyboard = [
@@ -112,16 +137,8 @@ def get_ai_chat_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
-def get_notifications_keyboard(enabled: bool) -> ReplyKeyboardMarkup:
-    """
-    Клавиатура управления уведомлениями
-    
-    Args:
-        enabled: True если уведомления включены, False если выключены
-        
-    Returns:
-        ReplyKeyboardMarkup с кнопками управления
-    """
+@lru_cache(maxsize=None)
+def _build_notifications_keyboard(enabled: bool) -> ReplyKeyboardMarkup:
     if enabled:
         keyboard = [
             [KeyboardButton("🔕 Выключить уведомления")],
@@ -136,5 +153,18 @@ def get_notifications_keyboard(enabled: bool) -> ReplyKeyboardMarkup:
             [KeyboardButton("🕒 Время: месяц")],
             [KeyboardButton("◀️ Назад в меню")]
         ]
-    
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
\ No newline at end of file
+
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+def get_notifications_keyboard(enabled: bool) -> ReplyKeyboardMarkup:
+    """
+    Клавиатура управления уведомлениями
+
+    Args:
+        enabled: True если уведомления включены, False если выключены
+
+    Returns:
+        ReplyKeyboardMarkup с кнопками управления
+    """
+    return _build_notifications_keyboard(bool(enabled))
@@ -1,15 +1,18 @@
 import logging
+import logging.handlers
 import os
 import time
 from telegram.ext import (
     Application,
     CommandHandler,
+    Defaults,
     MessageHandler,
     filters,
     ConversationHandler,
     ContextTypes,
     CallbackQueryHandler,
     PreCheckoutQueryHandler,
+    TypeHandler,
 )
 from telegram import Update
 from telegram.constants import ParseMode
@@ -17,8 +20,9 @@ from telegram.error import NetworkError, TimedOut
 
 from config import config
 from database import init_database
-from handlers import AuthHandlers, MenuHandlers, NotificationHandlers, PaymentHandlers, ReminderHandlers, GigaChatHandlers, REGISTRATION, API_TOKEN, WAITING_REMINDER_DATE, GIGACHAT_DIALOG
+from handlers import AuthHandlers, MenuHandlers, NotificationHandlers, PaymentHandlers, ReminderHandlers, GigaChatHandlers, RegistrationGate, close_api_clients, REGISTRATION, API_TOKEN, TOKEN_FILTER_PATTERN, WAITING_REMINDER_DATE, GIGACHAT_DIALOG
 from keyboards import get_main_menu
+from rate_limiter import TokenBucketRateLimiter
 from scheduler import StatisticsScheduler
 from moysklad_api import MoyskladAPI
 
@@ -30,77 +34,40 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
-    user = update.effective_user
-    logger.info(f"👋 Пользователь {user.id} ({user.first_name}) начал работу с ботом")
-
-    try:
-        # Инициализируем БД
-        db = init_database(config.DB_PATH)
-
-        # Проверяем регистрацию пользователя
-        user_data = db.get_user(user.id)
-        is_registered = user_data and user_data.get('api_token_encrypted')
-
-        # Формируем приветственное сообщение
-        if is_registered:
-            # Пользователь зарегистрирован
-            welcome_text = (
-                f"С возвращением, {user.first_name}! 👋\n\n"
-                "Я бот для работы со статистикой МойСклад.\n\n"
-                "*Доступные функции:*\n"
-                "• 📊 Быстрый отчет - сводка за сегодня, неделю и месяц\n"
-                "• 📊 Детальные отчеты - розничные продажи, заказы, отгрузки, объединенный отчет\n"
-                "• 📈 Аналитика - сравнение периодов\n"
-                "• ⚙️ Настройки - управление API-токеном\n\n"
-                "Используйте меню для навигации."
-            )
-            logger.info(f"✅ Зарегистрированный пользователь {user.id}")
-        else:
-            # Пользователь не зарегистрирован
-            welcome_text = (
-                f"Привет, {user.first_name}! 👋\n\n"
-                "Я бот для работы со статистикой МойСклад.\n\n"
-                "*Для начала работы необходимо:*\n"
-                "1. Зарегистрироваться по номеру телефона\n"
-                "2. Указать ваш API-токен МойСклад\n\n"
-                "API-токен можно получить:\n"
-                "1. Зайдите в МойСклад → Настройки → Безопасность\n"
-                "2. Создайте новый токен или скопируйте существующий\n\n"
-                "Используйте меню для навигации."
-            )
-            logger.info(f"⚠️ Незарегистрированный пользователь {user.id}")
-
-        # Отправляем приветствие с правильной клавиатурой
-        await update.message.reply_text(
-            welcome_text,
-            reply_markup=get_main_menu(is_registered),
-            parse_mode=ParseMode.MARKDOWN
-        )
-
-    except Exception as e:
-        logger.error(f"❌ Ошибка при проверке регистрации пользователя {user.id}: {e}", exc_info=True)
-
-        # В случае ошибки показываем стандартное приветствие
-        error_text = (
-            f"Привет, {user.first_name}! 👋\n\n"
-            "Я бот для работы со статистикой МойСклад.\n\n"
-            "⚠️ *Временные технические проблемы*\n"
-            "Не удалось проверить вашу регистрацию.\n\n"
-            "Попробуйте использовать кнопки меню."
-        )
+# Статические тексты /start и /help: собираются один раз при импорте,
+# в приветствия подставляется только имя пользователя
+_WELCOME_REGISTERED_TMPL = (
+    "С возвращением, {name}! 👋\n\n"
+    "Я бот для работы со статистикой МойСклад.\n\n"
+    "*Доступные функции:*\n"
+    "• 📊 Быстрый отчет - сводка за сегодня, неделю и месяц\n"
+    "• 📊 Детальные отчеты - розничные продажи, заказы, отгрузки, объединенный отчет\n"
+    "• 📈 Аналитика - сравнение периодов\n"
+    "• ⚙️ Настройки - управление API-токеном\n\n"
+    "Используйте меню для навигации."
+)
 
-        await update.message.reply_text(
-            error_text,
-            reply_markup=get_main_menu(False),
-            parse_mode=ParseMode.MARKDOWN
-        )
+_WELCOME_ANON_TMPL = (
+    "Привет, {name}! 👋\n\n"
+    "Я бот для работы со статистикой МойСклад.\n\n"
+    "*Для начала работы необходимо:*\n"
+    "1. Зарегистрироваться по номеру телефона\n"
+    "2. Указать ваш API-токен МойСклад\n\n"
+    "API-токен можно получить:\n"
+    "1. Зайдите в МойСклад → Настройки → Безопасность\n"
+    "2. Создайте новый токен или скопируйте существующий\n\n"
+    "Используйте меню для навигации."
+)
 
+_WELCOME_ERROR_TMPL = (
+    "Привет, {name}! 👋\n\n"
+    "Я бот для работы со статистикой МойСклад.\n\n"
+    "⚠️ *Временные технические проблемы*\n"
+    "Не удалось проверить вашу регистрацию.\n\n"
+    "Попробуйте использовать кнопки меню."
+)
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /help"""
-    help_text = """
+_HELP_TEXT = """
 📊 *Telegram Bot для МойСклад*
 
 *Доступные команды:*
@@ -130,8 +97,52 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 *Поддержка:*
 По вопросам работы бота обращайтесь к администратору @ustinalex
-    """
-    await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+"""
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start"""
+    user = update.effective_user
+    logger.info("👋 Пользователь %s (%s) начал работу с ботом", user.id, user.first_name)
+
+    try:
+        # Используем уже инициализированную БД из bot_data —
+        # без повторного init_database на каждый /start
+        db = context.bot_data['db']
+
+        # Проверяем регистрацию пользователя
+        user_data = db.get_user(user.id)
+        is_registered = user_data and user_data.get('has_token')
+
+        # Формируем приветственное сообщение
+        if is_registered:
+            welcome_text = _WELCOME_REGISTERED_TMPL.format(name=user.first_name)
+            logger.info("✅ Зарегистрированный пользователь %s", user.id)
+        else:
+            welcome_text = _WELCOME_ANON_TMPL.format(name=user.first_name)
+            logger.info("⚠️ Незарегистрированный пользователь %s", user.id)
+
+        # Отправляем приветствие с правильной клавиатурой
+        await update.message.reply_text(
+            welcome_text,
+            reply_markup=get_main_menu(is_registered),
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+    except Exception as e:
+        logger.error("❌ Ошибка при проверке регистрации пользователя %s: %s", user.id, e, exc_info=True)
+
+        # В случае ошибки показываем стандартное приветствие
+        await update.message.reply_text(
+            _WELCOME_ERROR_TMPL.format(name=user.first_name),
+            reply_markup=get_main_menu(False),
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /help"""
+    await update.message.reply_text(_HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
 
 
 def setup_handlers(application, db):
@@ -143,6 +154,13 @@ def setup_handlers(application, db):
     reminder = ReminderHandlers(db)
     ai_chat = GigaChatHandlers(db)
 
+    # ===== 0. Прехендлер группы -1: один get_user на апдейт и быстрый
+    # отказ незарегистрированным до запуска основных обработчиков.
+    # block=True обязателен: ApplicationHandlerStop работает только из
+    # блокирующего обработчика =====
+    gate = RegistrationGate(db)
+    application.add_handler(TypeHandler(Update, gate.precheck, block=True), group=-1)
+
     # ===== 1. СОЗДАЕМ ВСЕ ConversationHandler =====
 
     # ConversationHandler для регистрации
@@ -161,12 +179,19 @@ def setup_handlers(application, db):
                 # Из шага ввода токена тоже можно перезапустить регистрацию
                 MessageHandler(filters.Regex('^(📱 Регистрация)$'), auth.start_auth),
                 MessageHandler(filters.Regex('^(❌ Отмена регистрации)$'), auth.cancel_registration),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, auth.get_api_token),
+                # Формат токена проверяет фильтр роутера: мусорный ввод
+                # не планирует корутину проверки токена вообще
+                MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(TOKEN_FILTER_PATTERN),
+                               auth.get_api_token),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, auth.reject_invalid_token),
             ]
         },
         fallbacks=[
             CommandHandler('cancel', auth.cancel_registration)
-        ]
+        ],
+        # Сценарий регистрации мутирует состояние в context.user_data —
+        # оставляем последовательную обработку
+        block=True
     )
 
     # ConversationHandler для обновления токена
@@ -177,10 +202,13 @@ def setup_handlers(application, db):
         ],
         states={
             'WAITING_TOKEN': [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, auth.process_token_update)
+                MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(TOKEN_FILTER_PATTERN),
+                               auth.process_token_update),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, auth.reject_invalid_token_update),
             ]
         },
-        fallbacks=[CommandHandler('cancel', auth.cancel_registration)]
+        fallbacks=[CommandHandler('cancel', auth.cancel_registration)],
+        block=True
     )
 
     # ConversationHandler для напоминалок
@@ -196,7 +224,8 @@ def setup_handlers(application, db):
         },
         fallbacks=[
             CommandHandler('cancel', reminder.cancel_reminder)
-        ]
+        ],
+        block=True
     )
 
     # ConversationHandler для ИИ-ассистента
@@ -214,6 +243,7 @@ def setup_handlers(application, db):
             CommandHandler("cancel", ai_chat.exit_ai_chat),
             MessageHandler(filters.Regex(r'^(🔙 Назад)$'), ai_chat.exit_ai_chat),
         ],
+        block=True,
     )
 
     # 1. Сначала ConversationHandler
@@ -229,93 +259,20 @@ def setup_handlers(application, db):
     application.add_handler(CommandHandler("delete_me", auth.delete_account))
     application.add_handler(CommandHandler("notifications", notifications.notifications_command))
 
-    # 3. Детальные отчеты
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📊 Детальные отчеты)$'), menu.show_detailed_reports_menu
-    ))
-
-    # Выбор типа детального отчета
-    application.add_handler(MessageHandler(
-        filters.Regex('^(🛍 Розничные продажи)$'), menu.handle_retail_sales_report_menu
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📦 Заказы покупателей)$'), menu.handle_customer_orders_menu
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(🚚 Отгрузки)$'), menu.handle_demand_menu
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📊 Объединенный отчет)$'), menu.handle_combined_report_menu
-    ))
-
-    # 4. ✅ ВАЖНО: Обработчик ввода дат (должен быть перед периодом)
+    # 3. Обработчик ввода дат (специальный шаблон — остается регэкспом)
     application.add_handler(MessageHandler(
         filters.Regex(r'^(\d{1,2}\.\d{1,2}\.\d{4} - \d{1,2}\.\d{1,2}\.\d{4}|\d{1,2}\.\d{1,2}\.\d{4})$') &
         filters.ChatType.PRIVATE,
-        menu._handle_date_input  # ✅ Используем новый метод
-    ))
-
-    # 5. Обработчик кнопок периода для детальных отчетов
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📅 Сегодня|📆 Неделя|📈 Месяц|🗓 Произвольный период)$') &
-        filters.ChatType.PRIVATE,
-        menu.handle_detailed_period_selection
-    ))
-
-    # 6. Возврат из детальных отчетов
-    application.add_handler(MessageHandler(
-        filters.Regex('^(🔙 Назад к отчетам)$'), menu.show_detailed_reports_menu
-    ))
-
-    # 7. Кнопка Назад
-    application.add_handler(MessageHandler(
-        filters.Regex('^(🔙 Назад)$'), menu.handle_back
-    ))
-
-    # 8. Быстрый отчет
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📊 Быстрый отчет)$'), menu.handle_quick_report
+        menu._handle_date_input
     ))
 
-    # 9. Аналитика
+    # 4. Ввод времени уведомлений HH:MM
     application.add_handler(MessageHandler(
-        filters.Regex('^(📈 Аналитика)$'), menu.show_analytics_menu
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📈 Сегодня vs Вчера)$'), menu.compare_today_yesterday
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📅 Год назад)$'), menu.compare_year_ago
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📆 Неделя vs Прошлая)$'), menu.compare_week
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(📊 Месяц vs Прошлый)$'), menu.compare_month
-    ))
-
-    # 11. Топ-20 товаров за месяц
-    application.add_handler(MessageHandler(
-        filters.Regex('^(🧾 Топ-20 товаров)$'), menu.handle_top_products_month
-    ))
-
-    # 10. Настройки и помощь
-    application.add_handler(MessageHandler(
-        filters.Regex('^(⚙️ Настройки)$'), auth.show_settings
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(❌ Удалить аккаунт)$'), auth.delete_account
-    ))
-    application.add_handler(MessageHandler(
-        filters.Regex('^(ℹ️ Помощь)$'), help_command
-    ))
-
-    # 12. Подписка
-    application.add_handler(MessageHandler(
-        filters.Regex('^(💳 Подписка|Подписка)$'), menu.show_subscription_menu
+        filters.Regex(r'^\d{2}:\d{2}$'),
+        notifications.set_notification_time_input
     ))
 
-    # 12a. Платежи: callback «Оплатить в Telegram», PreCheckout, SuccessfulPayment
+    # 5. Платежи: callback «Оплатить в Telegram», PreCheckout, SuccessfulPayment
     application.add_handler(CallbackQueryHandler(
         payments.send_subscription_invoice,
         pattern="^pay_subscription$"
@@ -325,20 +282,55 @@ def setup_handlers(application, db):
         filters.SUCCESSFUL_PAYMENT, payments.successful_payment_callback
     ))
 
-    # 11. Управление уведомлениями (обработчики кнопок)
-    application.add_handler(MessageHandler(
-        filters.Regex('^(🔔 Включить уведомления|🔕 Выключить уведомления|◀️ Назад в меню|🕒 Время: ежедневно|🕒 Время: неделя|🕒 Время: месяц)$'),
-        notifications.toggle_notifications
-    ))
-
-    application.add_handler(MessageHandler(
-        filters.Regex(r'^\d{2}:\d{2}$'),
-        notifications.set_notification_time_input
-    ))
+    # 6. Кнопки меню: единый словарь "текст -> обработчик" вместо двух
+    # десятков Regex-фильтров, каждый из которых проверялся на каждом
+    # сообщении. Промах словаря уходит в show_main_menu — как раньше
+    # делал эхо-обработчик, поэтому диспетчер регистрируется последним.
+    button_dispatch = {
+        # Детальные отчеты
+        '📊 Детальные отчеты': menu.show_detailed_reports_menu,
+        '🛍 Розничные продажи': menu.handle_retail_sales_report_menu,
+        '📦 Заказы покупателей': menu.handle_customer_orders_menu,
+        '🚚 Отгрузки': menu.handle_demand_menu,
+        '📊 Объединенный отчет': menu.handle_combined_report_menu,
+        # Периоды детальных отчетов
+        '📅 Сегодня': menu.handle_detailed_period_selection,
+        '📆 Неделя': menu.handle_detailed_period_selection,
+        '📈 Месяц': menu.handle_detailed_period_selection,
+        '🗓 Произвольный период': menu.handle_detailed_period_selection,
+        # Навигация
+        '🔙 Назад к отчетам': menu.show_detailed_reports_menu,
+        '🔙 Назад': menu.handle_back,
+        # Быстрый отчет и аналитика
+        '📊 Быстрый отчет': menu.handle_quick_report,
+        '📈 Аналитика': menu.show_analytics_menu,
+        '📈 Сегодня vs Вчера': menu.compare_today_yesterday,
+        '📅 Год назад': menu.compare_year_ago,
+        '📆 Неделя vs Прошлая': menu.compare_week,
+        '📊 Месяц vs Прошлый': menu.compare_month,
+        '🧾 Топ-20 товаров': menu.handle_top_products_month,
+        # Настройки и помощь
+        '⚙️ Настройки': auth.show_settings,
+        '❌ Удалить аккаунт': auth.delete_account,
+        'ℹ️ Помощь': help_command,
+        # Подписка
+        '💳 Подписка': menu.show_subscription_menu,
+        'Подписка': menu.show_subscription_menu,
+        # Управление уведомлениями
+        '🔔 Включить уведомления': notifications.toggle_notifications,
+        '🔕 Выключить уведомления': notifications.toggle_notifications,
+        '◀️ Назад в меню': notifications.toggle_notifications,
+        '🕒 Время: ежедневно': notifications.toggle_notifications,
+        '🕒 Время: неделя': notifications.toggle_notifications,
+        '🕒 Время: месяц': notifications.toggle_notifications,
+    }
+
+    async def dispatch_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        handler = button_dispatch.get(update.message.text, menu.show_main_menu)
+        return await handler(update, context)
 
-    # 12. Эхо-обработчик (последним)
     application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND, menu.show_main_menu
+        filters.TEXT & ~filters.COMMAND, dispatch_buttons
     ))
 
 def main():
@@ -348,19 +340,27 @@ def main():
         config.validate()
         config.setup_dirs()
     except ValueError as e:
-        logger.error(f"Configuration error: {e}")
+        logger.error("Configuration error: %s", e)
         return
 
-    # Запись логов в файл (папка logs уже создана в setup_dirs)
+    # Запись логов в файл (папка logs уже создана в setup_dirs).
+    # MemoryHandler буферизует записи и сбрасывает их в файл пачками
+    # (или сразу при ERROR) — без отдельной записи на диск на каждую
+    # команду пользователя
     log_file = os.path.join(config.LOGS_DIR, "bot.log")
     file_handler = logging.FileHandler(log_file, encoding="utf-8")
     file_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-    logging.getLogger().addHandler(file_handler)
-    logger.info(f"Логи записываются в {log_file}")
+    buffered_handler = logging.handlers.MemoryHandler(
+        capacity=100,
+        flushLevel=logging.ERROR,
+        target=file_handler,
+    )
+    logging.getLogger().addHandler(buffered_handler)
+    logger.info("Логи записываются в %s", log_file)
 
     # Инициализация базы данных
     db = init_database(config.DB_PATH)
-    logger.info(f"Database initialized at {config.DB_PATH}")
+    logger.info("Database initialized at %s", config.DB_PATH)
 
     # Проверка наличия токена для оплаты в Telegram
     if config.TELEGRAM_PROVIDER_TOKEN:
@@ -372,10 +372,24 @@ def main():
     while True:
         scheduler = None
         try:
-            # Создание приложения бота
-            application = Application.builder().token(config.BOT_TOKEN).build()
+            # Создание приложения бота: block=False и concurrent_updates,
+            # чтобы долгий отчет одного пользователя не блокировал остальных
+            application = (
+                Application.builder()
+                .token(config.BOT_TOKEN)
+                .defaults(Defaults(block=False))
+                .concurrent_updates(True)
+                # Токен-бакет на исходящие сообщения: ровный поток вместо
+                # всплесков, упирающихся в 429 и ретраи
+                .rate_limiter(TokenBucketRateLimiter())
+                # Аккуратно закрываем keep-alive клиенты МойСклад при остановке
+                .post_shutdown(close_api_clients)
+                .build()
+            )
 
-            # Настройка обработчиков
+            # Настройка обработчиков; БД кладем в bot_data,
+            # чтобы start() не открывал ее заново
+            application.bot_data['db'] = db
             setup_handlers(application, db)
 
             # Инициализация и запуск планировщика
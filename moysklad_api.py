@@ -1,14 +1,55 @@
 import asyncio
+import hashlib
 import httpx
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 from typing import Dict, List, Optional, Any, Tuple
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 
 from config import today_moscow
 
 logger = logging.getLogger(__name__)
 
+# Кеш разобранных отчетов по заказам: завершенные периоды (вчера, прошлая
+# неделя, исторические произвольные диапазоны) в МойСклад не меняются,
+# поэтому повторные нажатия "сравнить" не должны ходить в API заново.
+# Ключ — (хеш токена, date_from, date_to), чтобы не держать сам токен
+# в памяти и разделять кеш между аккаунтами. Обычный dict +
+# time.monotonic() вместо cachetools — лишняя зависимость не нужна.
+_REPORT_CACHE: Dict[tuple, Tuple[float, "MoyskladReport"]] = {}
+_REPORT_CACHE_MAX = 4096
+_REPORT_TTL = 3600.0        # завершенные периоды
+_REPORT_TTL_TODAY = 60.0    # период включает сегодня — данные еще копятся
+
+
+def _report_cache_get(key: tuple) -> Optional["MoyskladReport"]:
+    """Отчет из кеша, если срок его жизни не истек"""
+    cached = _REPORT_CACHE.get(key)
+    if cached is None:
+        return None
+    expires_at, report = cached
+    if expires_at <= time.monotonic():
+        _REPORT_CACHE.pop(key, None)
+        return None
+    # Обработчики переписывают report.period под отображаемый период —
+    # отдаем копию, чтобы не менять закешированный объект
+    return replace(report)
+
+
+def _report_cache_put(key: tuple, report: "MoyskladReport", ttl: float) -> None:
+    """Сохранение отчета в кеш с вытеснением протухших записей"""
+    if len(_REPORT_CACHE) >= _REPORT_CACHE_MAX:
+        now = time.monotonic()
+        expired = [k for k, (exp, _) in _REPORT_CACHE.items() if exp <= now]
+        for k in expired:
+            _REPORT_CACHE.pop(k, None)
+        # Если протухших не нашлось — выкидываем самые старые записи
+        while len(_REPORT_CACHE) >= _REPORT_CACHE_MAX:
+            _REPORT_CACHE.pop(next(iter(_REPORT_CACHE)))
+    _REPORT_CACHE[key] = (time.monotonic() + ttl, report)
+
 
 @dataclass
 class MoyskladReport:
@@ -148,34 +189,33 @@ class QuickReport:
         month_retail_percent = (self.month_data['retail_sales'] / month_total * 100) if month_total > 0 else 0
         month_orders_percent = (self.month_data['order_sales'] / month_total * 100) if month_total > 0 else 0
 
-        report = f"📊 *БЫСТРЫЙ ОТЧЕТ за {self.month_name}*\n"
-        report += "=" * 30 + "\n\n"
-
-        # Сегодня
-        report += f"*СЕГОДНЯ  ({self.today_date}):*\n\n"
-        report += f"🛍 Розничные продажи: ({self.today_data.get('retail_count', '—')})\n {self.today_data['retail_sales']:,.2f} ₽  ({today_retail_percent:.1f}%)\n\n"
-        report += f"📦 Заказы покупателей: {self.today_data['order_sales']:,.2f} ₽ ({today_orders_percent:.1f}%)\n"
-        report += f"   Количество заказов: {self.today_data.get('order_count', '—')}\n"
-        report += f"💰 *Итого за день:* {today_total:,.2f} ₽\n\n"
-
-        # Неделя
-        report += f"*НЕДЕЛЯ \n ({self.week_period}):*\n\n"
-        report += f"🛍 Розничные продажи: {self.week_data.get('retail_count', '—')} \n   {self.week_data['retail_sales']:,.2f} ₽ ({week_retail_percent:.1f}%)\n\n"
-
-        report += f"📦 Заказы покупателей: {self.week_data['order_sales']:,.2f} ₽ ({week_orders_percent:.1f}%)\n"
-        report += f"   Количество заказов: {self.week_data.get('order_count', '—')}\n\n"
-        report += f"💰 *Итого за неделю:* {week_total:,.2f} ₽\n\n\n"
-
-
-        # Месяц
-        report += f"*МЕСЯЦ ({self.month_name}):*\n\n"
-        report += f"🛍 Розничные продажи: ({self.month_data.get('retail_count', '—')})\n Итого:{self.month_data['retail_sales']:,.2f} ₽ ({month_retail_percent:.1f}%)\n\n"
-        report += f"📦 Заказы покупателей: ({self.month_data.get('order_count', '—')})\n {self.month_data['order_sales']:,.2f} ₽ ({month_orders_percent:.1f}%)\n"
-        report += f"💰 *ИТОГО за месяц:*\n **{month_total:,.2f}** ₽\n\n"
-
-        report += "Отличные показатели, так держать!"
-
-        return report
+        # Одно f-string-выражение вместо цепочки += — без промежуточных строк
+        return (
+            f"📊 *БЫСТРЫЙ ОТЧЕТ за {self.month_name}*\n"
+            f"{'=' * 30}\n\n"
+
+            # Сегодня
+            f"*СЕГОДНЯ  ({self.today_date}):*\n\n"
+            f"🛍 Розничные продажи: ({self.today_data.get('retail_count', '—')})\n {self.today_data['retail_sales']:,.2f} ₽  ({today_retail_percent:.1f}%)\n\n"
+            f"📦 Заказы покупателей: {self.today_data['order_sales']:,.2f} ₽ ({today_orders_percent:.1f}%)\n"
+            f"   Количество заказов: {self.today_data.get('order_count', '—')}\n"
+            f"💰 *Итого за день:* {today_total:,.2f} ₽\n\n"
+
+            # Неделя
+            f"*НЕДЕЛЯ \n ({self.week_period}):*\n\n"
+            f"🛍 Розничные продажи: {self.week_data.get('retail_count', '—')} \n   {self.week_data['retail_sales']:,.2f} ₽ ({week_retail_percent:.1f}%)\n\n"
+            f"📦 Заказы покупателей: {self.week_data['order_sales']:,.2f} ₽ ({week_orders_percent:.1f}%)\n"
+            f"   Количество заказов: {self.week_data.get('order_count', '—')}\n\n"
+            f"💰 *Итого за неделю:* {week_total:,.2f} ₽\n\n\n"
+
+            # Месяц
+            f"*МЕСЯЦ ({self.month_name}):*\n\n"
+            f"🛍 Розничные продажи: ({self.month_data.get('retail_count', '—')})\n Итого:{self.month_data['retail_sales']:,.2f} ₽ ({month_retail_percent:.1f}%)\n\n"
+            f"📦 Заказы покупателей: ({self.month_data.get('order_count', '—')})\n {self.month_data['order_sales']:,.2f} ₽ ({month_orders_percent:.1f}%)\n"
+            f"💰 *ИТОГО за месяц:*\n **{month_total:,.2f}** ₽\n\n"
+
+            "Отличные показатели, так держать!"
+        )
 
 class MoyskladAPI:
     """Класс для работы с API МойСклад (асинхронный)"""
@@ -191,8 +231,15 @@ class MoyskladAPI:
                 "Content-Type": "application/json",
             },
             timeout=30.0,
+            # Ограничиваем пул keep-alive соединений к одному хосту API:
+            # постраничные отчеты переиспользуют их вместо новых TLS-сессий
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
         )
         self._assortment_cache: Dict[str, str] = {}
+        # Схлопывание одновременных одинаковых запросов: при всплеске
+        # нагрузки N параллельных запросов одного периода превращаются
+        # в один поход в API, остальные ждут общий Future
+        self._inflight: Dict[tuple, asyncio.Future] = {}
 
     async def aclose(self):
         """Закрытие HTTP-клиента"""
@@ -241,7 +288,49 @@ class MoyskladAPI:
             return None
 
     async def get_sales_report(self, date_from: str, date_to: str) -> Optional[MoyskladReport]:
-        """Получение отчета по заказам покупателей за период"""
+        """Получение отчета по заказам покупателей за период (с кешем)"""
+        key = (
+            hashlib.blake2b(self.api_token.encode(), digest_size=8).digest(),
+            date_from,
+            date_to,
+        )
+
+        report = _report_cache_get(key)
+        if report is not None:
+            logger.info(f"📦 Отчет продаж {date_from} - {date_to} из кеша")
+            return report
+
+        # Такой же запрос уже в полете — ждем его результат вместо
+        # дублирующего похода в API
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            logger.info(f"⏳ Отчет продаж {date_from} - {date_to} уже запрошен, ждем")
+            return await asyncio.shield(inflight)
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            report = await self._fetch_sales_report(date_from, date_to)
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # чтобы не было "exception never retrieved" без ожидающих
+            raise
+        else:
+            fut.set_result(report)
+        finally:
+            self._inflight.pop(key, None)
+
+        if report is not None:
+            # Периоды, захватывающие сегодня, кешируем коротко
+            ttl = _REPORT_TTL_TODAY if date_to >= today_moscow().isoformat() else _REPORT_TTL
+            # В кеш кладем копию: объект, который вернем вызывающему,
+            # дальше мутируется обработчиками (report.period)
+            _report_cache_put(key, replace(report), ttl)
+
+        return report
+
+    async def _fetch_sales_report(self, date_from: str, date_to: str) -> Optional[MoyskladReport]:
+        """Запрос и разбор отчета по заказам покупателей из API"""
         logger.info(f"📊 Запрос отчета продаж с {date_from} по {date_to}")
 
         params = {
@@ -1032,8 +1121,14 @@ def get_period_dates(period_type: str) -> tuple:
     Returns:
         tuple: (date_from, date_to) в формате 'YYYY-MM-DD'
     """
-    today = today_moscow()
+    # Границы периода зависят только от текущей даты по Москве, поэтому
+    # арифметику с timedelta и strftime достаточно выполнить один раз в
+    # сутки на каждый тип периода
+    return _period_dates_for_day(period_type, today_moscow())
+
 
+@lru_cache(maxsize=32)
+def _period_dates_for_day(period_type: str, today: date) -> tuple:
     if period_type == 'today':
         date_from = date_to = today.strftime('%Y-%m-%d')
 
@@ -0,0 +1,95 @@
+"""Ограничитель исходящих запросов к Telegram Bot API.
+
+Telegram допускает ~30 сообщений в секунду на бота и ~1 сообщение в
+секунду в один чат. Без ограничителя всплеск рассылки упирается в
+HTTP 429, и ретраи с экспоненциальной паузой только усугубляют очередь.
+Штатный AIORateLimiter требует extras-зависимость aiolimiter, поэтому
+здесь свой токен-бакет на stdlib, подключаемый через
+Application.builder().rate_limiter(...).
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# 28 вместо 30 — запас, чтобы не балансировать на самом лимите
+GLOBAL_RATE = 28.0
+# Минимальный интервал между сообщениями в один чат, секунд
+PER_CHAT_INTERVAL = 1.0
+# Порог, после которого чистим таблицу чатов от неактуальных записей
+_CHAT_SLOTS_PRUNE = 2048
+
+
+class _TokenBucket:
+    """Ведро токенов: rate запросов в секунду, без внешних зависимостей"""
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._updated) * self._rate,
+                )
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self._rate)
+
+
+class TokenBucketRateLimiter(BaseRateLimiter[int]):
+    """Глобальный + початовый лимит на исходящие вызовы с chat_id.
+
+    Вызовы без chat_id (getUpdates, answerCallbackQuery и т.п.)
+    пропускаются без задержки.
+    """
+
+    def __init__(self):
+        self._global_bucket = _TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        # chat_id -> время monotonic, раньше которого в этот чат не шлем
+        self._chat_slots: Dict[Any, float] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _throttle_chat(self, chat_id: Any) -> None:
+        now = time.monotonic()
+        slot = max(now, self._chat_slots.get(chat_id, now))
+        self._chat_slots[chat_id] = slot + PER_CHAT_INTERVAL
+        if len(self._chat_slots) > _CHAT_SLOTS_PRUNE:
+            self._chat_slots = {
+                cid: t for cid, t in self._chat_slots.items() if t > now
+            }
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get("chat_id")
+        if chat_id is not None:
+            await self._throttle_chat(chat_id)
+            await self._global_bucket.acquire()
+        return await callback(*args, **kwargs)
@@ -57,7 +57,7 @@ def check_subscription(db, telegram_id: int, now: Optional[datetime] = None) ->
         }
 
     user = db.get_user(telegram_id)
-    if not user or not user.get("api_token_encrypted"):
+    if not user or not user.get("has_token"):
         return {
             "ok": False,
             "mode": None,